@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import os, time
+
+from PyQt5.Qt import (QObject, QTimer, QApplication, pyqtSignal)
+
+from calibre_plugins.smarteject.common_utils import get_library_uuid
+from calibre_plugins.smarteject.idset import IdSet
+from calibre_plugins.smarteject.fingerprints import get_device_uuid
+from calibre_plugins.smarteject.libraryindex import LibraryIndex
+from calibre_plugins.smarteject.warmcache import (read_entry, write_entry, load_cache,
+                                                   device_books_stamp)
+from calibre_plugins.smarteject.config import prefs
+from calibre_plugins.smarteject.searches import (search_library, search_device,
+                                                 any_library_match, any_device_match,
+                                                 is_native_search, iter_device_ids,
+                                                 native_dups, native_notondevice,
+                                                 is_notinlibrary, scope_search, scope_ids,
+                                                 library_candidates, matching_book_ids,
+                                                 matching_device_ids)
+
+# pulls in translation files for _() strings
+try:
+    load_translations()
+except NameError:
+    pass # load_translations() added in calibre 1.9
+
+# (view attribute on gui, name shown to user, location name)
+DEVICE_LOCATIONS = [ ('memory_view', 'Main', 'main'),
+                     ('card_a_view', 'Card A', 'carda'),
+                     ('card_b_view', 'Card B', 'cardb') ]
+
+# Library checks that are limited to a device's scope.
+SCOPED_KEYS = ('checkdups_search', 'checknotondevice_search')
+
+# Books handled between checks of the time budget.
+CHUNK = 100
+
+# Books searched per step by searches other than the defaults, which
+# cost more per book.
+SEARCH_CHUNK = 500
+
+# How long to wait before looking again when calibre is busy.
+BUSY_RETRY_MS = 500
+
+class AuditEngine(object):
+    '''
+    Keeps the results of the eject checks for the current library and
+    device so they can be worked out ahead of time and reused until
+    either changes.  Everything here must run on the GUI thread.
+    '''
+    def __init__(self, gui):
+        self.gui = gui
+        self.other_libraries = LibraryIndex()
+        # results saved by the last calibre run, read on first use.
+        self.saved = None
+        # bumped by device_books_changed() each time the device's
+        # book lists really change.
+        self.device_version = 0
+        self.device_books = None
+        self.reset()
+
+    def reset(self):
+        self.stamp = None
+        self.results = {}
+        # (library stamp, scope search) -> IdSet
+        self.scopes = {}
+        # stage name -> stamp_for() when it was resolved.
+        self.resolved = {}
+
+    def library_stamp(self):
+        db = self.gui.current_db
+        try:
+            restriction = db.data.get_base_restriction()
+        except:
+            restriction = None
+        return (get_library_uuid(db), db.last_modified(), restriction)
+
+    def device_books_changed(self):
+        '''
+        Called whenever calibre may have changed the device book lists.
+        Only bumps device_version if the books in them did change,
+        which searching a device view, say, doesn't.
+        '''
+        books = device_books_stamp(self.gui)
+        if books != self.device_books:
+            self.device_books = books
+            self.device_version += 1
+
+    def device_stamp(self):
+        if not self.gui.device_manager.is_device_connected:
+            return None
+        return self.device_version
+
+    def current_stamp(self):
+        return (self.library_stamp(), self.device_stamp())
+
+    def stamp_for(self, depends):
+        '''
+        Stamp of just the things in depends, 'library' and/or 'device'.
+        '''
+        return (self.library_stamp() if 'library' in depends else None,
+                self.device_stamp() if 'device' in depends else None)
+
+    def check_stamp(self):
+        '''
+        Drop all results if the library or device changed since they
+        were computed.
+        '''
+        stamp = self.current_stamp()
+        if stamp != self.stamp:
+            self.results = {}
+            self.stamp = stamp
+            self.restore()
+
+    def restore(self):
+        '''
+        The first time a device is connected with each library, take
+        back the results saved by save() if neither has changed since.
+        '''
+        if not prefs['keepprecheck'] or self.stamp[1] is None:
+            return
+        if self.saved is None:
+            self.saved = load_cache()
+        if not self.saved:
+            return
+        (results, scopes) = read_entry(self.gui, self.saved)
+        self.results.update(results)
+        library_stamp = self.stamp[0]
+        for search, ids in scopes.items():
+            self.scopes.setdefault((library_stamp, search), ids)
+
+    def save(self):
+        '''
+        Save the current search results so the first eject after
+        calibre restarts doesn't have to compute them all again.
+        '''
+        if not prefs['keepprecheck'] or self.stamp is None \
+                or self.stamp[1] is None or self.current_stamp() != self.stamp:
+            return
+        library_stamp = self.stamp[0]
+        write_entry(self.gui, self.results,
+                    dict([ (k, v) for k, v in self.scopes.items() if k[0] == library_stamp ]))
+
+    def wanted(self):
+        '''
+        Returns the (key, location) of each result the enabled checks
+        will need.  location is None for library searches.
+        '''
+        wanted = []
+        if prefs['checkdups']:
+            wanted.append(('checkdups_search', None))
+        if prefs['checknotinlibrary']:
+            wanted.extend([ ('checknotinlibrary_search', i) for i in range(len(DEVICE_LOCATIONS)) ])
+        if prefs['checknotondevice']:
+            wanted.append(('checknotondevice_search', None))
+        return wanted
+
+    def is_warm(self):
+        self.check_stamp()
+        return all([ self.result_key(w) in self.results for w in self.wanted() ])
+
+    def result_key(self, wanted):
+        (key, location) = wanted
+        if location is None and key in SCOPED_KEYS:
+            return (key, location, prefs[key], self.scope_search())
+        if location is not None and key == 'checknotinlibrary_search':
+            paths = self.other_library_paths()
+            if paths:
+                return (key, location, prefs[key], self.other_libraries.stamp(paths))
+        return (key, location, prefs[key])
+
+    def other_library_paths(self):
+        '''
+        The other libraries checked for books not in the current one,
+        or an empty list.
+        '''
+        if not prefs['checkotherlibraries']:
+            return []
+        current = os.path.normcase(os.path.abspath(self.gui.current_db.library_path))
+        return [ path for path in prefs['otherlibraries']
+                 if os.path.normcase(os.path.abspath(path)) != current ]
+
+    def not_in_other_libraries(self, location, found):
+        '''
+        Those of the device book indexes in found at location that also
+        aren't in any of the other libraries.
+        '''
+        paths = self.other_library_paths()
+        if not paths or not found:
+            return found
+        return self.other_libraries.filter(self.view(location).model().db, found)
+
+    def other_libraries_ready(self):
+        '''
+        True if not_in_other_libraries() can be used now.  Otherwise
+        starts bringing the other libraries' index up to date in a
+        background thread; ask again later.
+        '''
+        paths = self.other_library_paths()
+        if not paths or self.other_libraries.is_current(paths):
+            return True
+        self.other_libraries.start_refresh(paths)
+        return False
+
+    def scope_search(self):
+        '''
+        The search for the books the connected device is limited to, or
+        None.
+        '''
+        scope = prefs['device_scopes'].get(get_device_uuid(self.gui))
+        return scope_search(self.gui.current_db, scope)
+
+    def scope(self, key):
+        '''
+        IdSet of the books key's check is limited to on the connected
+        device, or None.  Only changes with the library, so kept
+        separately from the other results.
+        '''
+        search = self.scope_search()
+        if key not in SCOPED_KEYS or search is None:
+            return None
+        sk = (self.library_stamp(), search)
+        if sk not in self.scopes:
+            self.scopes = dict([ (k, v) for k, v in self.scopes.items() if k[0] == sk[0] ])
+            self.scopes[sk] = scope_ids(self.gui.current_db, search)
+        return self.scopes[sk]
+
+    def display_search(self, key):
+        '''
+        The search to show the user for key's check, including the
+        connected device's scope.
+        '''
+        search = self.scope_search()
+        if key not in SCOPED_KEYS or search is None:
+            return prefs[key]
+        return '(%s) and (%s)'%(prefs[key], search)
+
+    def has_result(self, key, location=None):
+        '''
+        True if the result for key (and location), or at least whether
+        it's empty, is already computed.
+        '''
+        self.check_stamp()
+        rk = self.result_key((key, location))
+        return rk in self.results or ('any',)+rk in self.results
+
+    def library_any(self, key):
+        '''
+        True if the configured search for key matches any library book.
+        Uses the full result if there is one, but doesn't compute it.
+        '''
+        self.check_stamp()
+        rk = self.result_key((key, None))
+        if rk in self.results:
+            return bool(self.results[rk])
+        if ('any',)+rk not in self.results:
+            self.results[('any',)+rk] = any_library_match(self.gui, key, prefs[key], self.scope(key))
+        return self.results[('any',)+rk]
+
+    def device_any(self, key, location):
+        '''
+        Like library_any() for the device book list at location.
+        '''
+        self.check_stamp()
+        rk = self.result_key((key, location))
+        if rk in self.results:
+            return bool(self.results[rk])
+        if key == 'checknotinlibrary_search' and self.other_library_paths():
+            # any match might be in another library.
+            return bool(self.device_result(key, location))
+        if ('any',)+rk not in self.results:
+            self.results[('any',)+rk] = any_device_match(self.view(location).model(), key, prefs[key])
+        return self.results[('any',)+rk]
+
+    def has_cached(self, name, func, *args):
+        '''
+        True if cached(name, func, *args) already has its result.
+        '''
+        self.check_stamp()
+        return (name, None, args) in self.results
+
+    def view(self, location):
+        return getattr(self.gui, DEVICE_LOCATIONS[location][0])
+
+    def library_result(self, key):
+        '''
+        IdSet of library book ids matching the configured search for key.
+        '''
+        self.check_stamp()
+        rk = self.result_key((key, None))
+        if rk not in self.results:
+            self.results[rk] = search_library(self.gui, key, prefs[key], self.scope(key))
+        return self.results[rk]
+
+    def device_result(self, key, location):
+        '''
+        IdSet of indexes into the device book list at location matching
+        the configured search for key.
+        '''
+        self.check_stamp()
+        rk = self.result_key((key, location))
+        if rk not in self.results:
+            found = search_device(self.view(location).model(), key, prefs[key])
+            if key == 'checknotinlibrary_search':
+                found = self.not_in_other_libraries(location, found)
+            self.results[rk] = found
+        return self.results[rk]
+
+    def cached(self, name, func, *args):
+        '''
+        Result of func(*args), computed once per library and device
+        stamp under name.
+        '''
+        self.check_stamp()
+        rk = (name, None, args)
+        if rk not in self.results:
+            self.results[rk] = func(*args)
+        return self.results[rk]
+
+    def iter_work(self):
+        '''
+        Generator computing every result the enabled checks need a
+        little at a time.  Yields (done, total) books looked at after
+        each step so the caller can stop when its time budget is used
+        up, or None while waiting on another thread.  Stops early if
+        the library or device changes underneath it.
+        '''
+        self.check_stamp()
+        stamp = self.stamp
+        db = self.gui.library_view.model().db
+        todo = [ w for w in self.wanted() if self.result_key(w) not in self.results ]
+        native = [ w for w in todo if w[1] is None and is_native_search(w[0], prefs[w[0]]) ]
+        # the books each of the others will look at.
+        candidates = {}
+        for w in todo:
+            (key, location) = w
+            if w in native:
+                continue
+            if location is None:
+                candidates[w] = library_candidates(db, self.scope(key))
+            else:
+                candidates[w] = list(range(len(self.view(location).model().db)))
+        device_books = sum([ len(bl) for bl in self.gui.booklists() ]) \
+            if native and self.gui.device_manager.is_device_connected else 0
+        total = max(1, device_books + sum([ len(c) for c in candidates.values() ]))
+        done = 0
+
+        if native:
+            # the native library checks share one pass over the device.
+            counts = {}
+            for book_id in iter_device_ids(self.gui):
+                counts[book_id] = counts.get(book_id, 0) + 1
+                done += 1
+                if done % CHUNK == 0:
+                    yield (done, total)
+                    if self.current_stamp() != stamp:
+                        return
+            for w in native:
+                func = native_dups if w[0] == 'checkdups_search' else native_notondevice
+                self.results[self.result_key(w)] = func(self.gui, db, counts, self.scope(w[0]))
+            yield (done, total)
+
+        for w in todo:
+            if w in native:
+                continue
+            if self.current_stamp() != stamp:
+                return
+            (key, location) = w
+            ids = candidates[w]
+            # built into an IdSet once at the end.
+            found = []
+            if location is not None and is_native_search(key, prefs[key]):
+                books = self.view(location).model().db
+                for i in range(0, len(ids), CHUNK):
+                    chunk = ids[i:i+CHUNK]
+                    found.extend([ j for j in chunk if is_notinlibrary(books[j]) ])
+                    done += len(chunk)
+                    yield (done, total)
+                    if self.current_stamp() != stamp:
+                        return
+            else:
+                for i in range(0, len(ids), SEARCH_CHUNK):
+                    chunk = ids[i:i+SEARCH_CHUNK]
+                    if location is None:
+                        found.extend(matching_book_ids(db, prefs[key], chunk))
+                    else:
+                        found.extend(matching_device_ids(self.view(location).model(), prefs[key], chunk))
+                    done += len(chunk)
+                    yield (done, total)
+                    if self.current_stamp() != stamp:
+                        return
+            found = IdSet(found)
+            paths = self.other_library_paths()
+            if key == 'checknotinlibrary_search' and paths and found:
+                # reading the other libraries is left to a thread.
+                while not self.other_libraries_ready():
+                    yield None
+                if self.current_stamp() != stamp:
+                    return
+                found = self.not_in_other_libraries(location, found)
+            self.results[self.result_key(w)] = found
+            yield (done, total)
+
+class Prewarmer(QObject):
+    '''
+    Runs AuditEngine.iter_work() from a timer, a few milliseconds at a
+    time, whenever calibre is idle and a device is connected.
+    '''
+    # done, total; done stays below total until finished.
+    progress = pyqtSignal(object, object)
+    # every result the enabled checks need is computed and stored.
+    finished = pyqtSignal()
+
+    def __init__(self, engine, parent=None):
+        QObject.__init__(self, parent)
+        self.engine = engine
+        self.gui = engine.gui
+        self.work = None
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        if not prefs['prewarm'] or not self.gui.device_manager.is_device_connected:
+            self.stop()
+            return
+        self.work = None
+        # A zero interval timer fires each time the event loop has
+        # nothing else to do.
+        self.timer.start(0)
+
+    def stop(self):
+        self.timer.stop()
+        self.work = None
+
+    def is_idle(self):
+        return QApplication.activeModalWidget() is None and \
+            not self.gui.job_manager.has_jobs()
+
+    def tick(self):
+        if not self.gui.device_manager.is_device_connected:
+            self.stop()
+            return
+        if not self.is_idle():
+            self.timer.setInterval(BUSY_RETRY_MS)
+            return
+        self.timer.setInterval(0)
+        if self.work is None:
+            if self.engine.is_warm():
+                self.stop()
+                return
+            self.work = self.engine.iter_work()
+        deadline = time.time() + max(1, prefs['prewarmslicems'])/1000.0
+        (done, total) = (0, 1)
+        try:
+            while time.time() < deadline:
+                step = next(self.work)
+                if step is None:
+                    # waiting on another thread, look again later.
+                    self.timer.setInterval(BUSY_RETRY_MS)
+                    return
+                (done, total) = step
+        except StopIteration:
+            # finished, or started over because something changed.
+            self.work = None
+            if self.engine.is_warm():
+                self.stop()
+                self.finished.emit()
+            return
+        # the last step's results may not be stored yet.
+        self.progress.emit(min(done, total-1), total)
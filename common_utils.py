@@ -14,7 +14,7 @@ from PyQt5 import QtWidgets as QtGui
 from PyQt5.Qt import (Qt, QIcon, QPixmap, QLabel, QDialog, QHBoxLayout,
                       QTableWidgetItem, QFont, QLineEdit, QComboBox,
                       QVBoxLayout, QDialogButtonBox, QStyledItemDelegate, QDateTime,
-                      QTextEdit, QListWidget, QAbstractItemView)
+                      QTextEdit, QListWidget, QAbstractItemView, QApplication)
 
 from calibre.constants import iswindows
 from calibre.gui2 import gprefs, error_dialog, UNDEFINED_QDATETIME, info_dialog
@@ -251,3 +251,40 @@ class PrefsViewerDialog(SizePersistedDialog):
         if d.do_restart:
             self.gui.quit(restart=True)
 
+
+class TextViewerDialog(SizePersistedDialog):
+    '''
+    Shows read-only text, such as a saved profile, with a button to
+    copy it all to the clipboard.
+    '''
+    def __init__(self, gui, title, text, note=None):
+        SizePersistedDialog.__init__(self, gui, 'Text Viewer dialog')
+        self.setWindowTitle(title)
+
+        layout = QVBoxLayout(self)
+        self.setLayout(layout)
+
+        if note:
+            label = QLabel(note, self)
+            label.setWordWrap(True)
+            label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+            layout.addWidget(label)
+
+        self.text = QTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QTextEdit.NoWrap)
+        self.text.setFont(QFont('monospace'))
+        self.text.setPlainText(text)
+        layout.addWidget(self.text, 1)
+
+        button_box = QDialogButtonBox(QDialogButtonBox.Ok)
+        button_box.accepted.connect(self.accept)
+        self.copy_button = button_box.addButton(_('Copy to clipboard'), QDialogButtonBox.ActionRole)
+        self.copy_button.setIcon(get_icon('edit-copy.png'))
+        self.copy_button.clicked.connect(self._copy_to_clipboard)
+        layout.addWidget(button_box)
+
+        self.resize_dialog()
+
+    def _copy_to_clipboard(self):
+        QApplication.clipboard().setText(self.text.toPlainText())
@@ -7,14 +7,17 @@ __license__   = 'GPL v3'
 __copyright__ = '2019, Jim Miller'
 __docformat__ = 'restructuredtext en'
 
-import traceback, copy
+import traceback, copy, threading
+from collections import OrderedDict
 import six
 from six import text_type as unicode
 
 from PyQt5.Qt import (QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
-                      QCheckBox, QPushButton, QTabWidget, QScrollArea)
+                      QCheckBox, QPushButton, QTabWidget, QScrollArea,
+                      QSpinBox, QObject, QTimer, pyqtSignal, QComboBox,
+                      QGridLayout, QListWidget, QListWidgetItem, Qt)
 
-from calibre.gui2 import dynamic, info_dialog
+from calibre.gui2 import dynamic, gprefs, info_dialog
 from calibre.gui2.ui import get_gui
 
 # pulls in translation files for _() strings
@@ -24,7 +27,18 @@ except NameError:
     pass # load_translations() added in calibre 1.9
 
 from calibre_plugins.smarteject.common_utils \
-    import ( get_library_uuid, KeyboardConfigDialog, PrefsViewerDialog )
+    import ( get_library_uuid, KeyboardConfigDialog, PrefsViewerDialog,
+             TextViewerDialog )
+
+# Wait this long after typing stops before counting a search's
+# matches.
+COUNT_DELAY_MS = 500
+
+# How often to look for counts finished in the background.
+COUNT_POLL_MS = 100
+
+# Most search counts remembered at once.
+MAX_COUNTS = 50
 
 PREFS_NAMESPACE = 'SmartEjectPlugin'
 PREFS_KEY_SETTINGS = 'settings'
@@ -44,12 +58,70 @@ default_prefs['checknotondevice'] = True
 default_prefs['deletedups'] = False
 default_prefs['deletenotinlibrary'] = False
 default_prefs['sendnotondevice'] = False
+default_prefs['preconvertnotondevice'] = False
 
 default_prefs['checkdups_search'] = r'ondevice:"~\\("'
 default_prefs['checknotinlibrary_search'] = 'inlibrary:False'
 default_prefs['checknotondevice_search'] = 'not ondevice:"~[a-z]"'
 
+default_prefs['checkstale'] = False
+default_prefs['sendstale'] = False
+default_prefs['stalehashes'] = False
+
+default_prefs['checkmetadata'] = False
+default_prefs['updatemetadata'] = False
+
 default_prefs['stopsmartdevice'] = False
+default_prefs['ejectwhenidle'] = False
+
+# Also look for books not in this library in these other libraries.
+default_prefs['checkotherlibraries'] = False
+default_prefs['otherlibraries'] = []
+
+# device uuid -> {'name':..., 'type':one of searches.SCOPE_TYPES, 'value':...}
+default_prefs['device_scopes'] = {}
+
+default_prefs['profilenexteject'] = False
+
+default_prefs['prewarm'] = True
+default_prefs['prewarmslicems'] = 5
+default_prefs['showprewarmprogress'] = False
+default_prefs['keepprecheck'] = True
+
+# Version of the settings stored in each library.  Bump it and add a
+# migration below whenever stored settings need to change.  Libraries
+# saved before versioning count as version 0.
+SCHEMA_VERSION = 1
+default_prefs['schema_version'] = SCHEMA_VERSION
+
+# schema version -> function upgrading library_config from the
+# previous version, in place.
+migrations = {}
+
+def register_migration(version, func):
+    migrations[version] = func
+
+def migrate_dups_search(library_config):
+    # As of Calibre 5.42, the duplicate search needs to change.
+    # Automatically change it if it's the old default search.
+    if library_config.get('checkdups_search') == 'ondevice:"("':
+        library_config['checkdups_search'] = default_prefs['checkdups_search']
+        print("checkdups_search changed to new default value.")
+register_migration(1, migrate_dups_search)
+
+def migrate_library_config(library_config):
+    '''
+    Upgrade library_config in place to SCHEMA_VERSION.  Returns True if
+    anything was done and it needs saving.
+    '''
+    version = library_config.get('schema_version', 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    for v in range(version+1, SCHEMA_VERSION+1):
+        if v in migrations:
+            migrations[v](library_config)
+    library_config['schema_version'] = SCHEMA_VERSION
+    return True
 
 def set_library_config(library_config):
     get_gui().current_db.prefs.set_namespaced(PREFS_NAMESPACE,
@@ -61,6 +133,8 @@ def get_library_config():
     library_id = get_library_uuid(db)
     library_config = db.prefs.get_namespaced(PREFS_NAMESPACE, PREFS_KEY_SETTINGS,
                                              copy.deepcopy(default_prefs))
+    if migrate_library_config(library_config):
+        set_library_config(library_config)
     return library_config
 
 # fake out so I don't have to change the prefs calls anywhere.  The
@@ -118,6 +192,12 @@ class ConfigWidget(QWidget):
         self.searches_tab = SearchesTab(self, plugin_action)
         tab_widget.addTab(self.searches_tab, _('Searches'))
 
+        self.devices_tab = DevicesTab(self, plugin_action)
+        tab_widget.addTab(self.devices_tab, _('Devices'))
+
+        self.libraries_tab = LibrariesTab(self, plugin_action)
+        tab_widget.addTab(self.libraries_tab, _('Libraries'))
+
     def save_settings(self):
         prefs['checkreadinglistsync'] = self.basic_tab.checkreadinglistsync.isChecked()
         prefs['checkreadinglistsyncfromdevice'] = self.basic_tab.checkreadinglistsyncfromdevice.isChecked()
@@ -130,14 +210,65 @@ class ConfigWidget(QWidget):
         prefs['deletedups'] = self.basic_tab.deletedups.isChecked()
         prefs['deletenotinlibrary'] = self.basic_tab.deletenotinlibrary.isChecked()
         prefs['sendnotondevice'] = self.basic_tab.sendnotondevice.isChecked()
+        prefs['preconvertnotondevice'] = self.basic_tab.preconvertnotondevice.isChecked()
 
+        changed = [ key for key in ('checkdups_search', 'checknotinlibrary_search', 'checknotondevice_search')
+                    if unicode(getattr(self.searches_tab,key).text()) != prefs[key] ]
         prefs['checkdups_search'] = unicode(self.searches_tab.checkdups_search.text())
         prefs['checknotinlibrary_search'] = unicode(self.searches_tab.checknotinlibrary_search.text())
         prefs['checknotondevice_search'] = unicode(self.searches_tab.checknotondevice_search.text())
+
+        prefs['checkstale'] = self.basic_tab.checkstale.isChecked()
+        prefs['sendstale'] = self.basic_tab.sendstale.isChecked()
+        prefs['stalehashes'] = self.basic_tab.stalehashes.isChecked()
+
+        prefs['checkmetadata'] = self.basic_tab.checkmetadata.isChecked()
+        prefs['updatemetadata'] = self.basic_tab.updatemetadata.isChecked()
+
         prefs['stopsmartdevice'] = self.basic_tab.stopsmartdevice.isChecked()
+        prefs['ejectwhenidle'] = self.basic_tab.ejectwhenidle.isChecked()
+
+        prefs['device_scopes'] = self.devices_tab.get_scopes()
+
+        prefs['checkotherlibraries'] = self.libraries_tab.checkotherlibraries.isChecked()
+        prefs['otherlibraries'] = self.libraries_tab.get_libraries()
+
+        prefs['profilenexteject'] = self.basic_tab.profilenexteject.isChecked()
+
+        prefs['prewarm'] = self.basic_tab.prewarm.isChecked()
+        prefs['prewarmslicems'] = self.basic_tab.prewarmslicems.value()
+        prefs['showprewarmprogress'] = self.basic_tab.showprewarmprogress.isChecked()
+        prefs['keepprecheck'] = self.basic_tab.keepprecheck.isChecked()
 
         prefs.save_to_db()
 
+        self.report_searches(changed)
+
+    def report_searches(self, keys):
+        '''
+        Warn about any of the just saved searches for keys that may make
+        ejecting slow.  Only changed searches are checked, and only
+        after saving--calibre has already closed the dialog by then.
+        '''
+        # Loaded here because searches imports default_prefs from here.
+        from calibre_plugins.smarteject.searches import check_search
+        det_msg = []
+        for key, label in [('checkdups_search',_("Search for Duplicated Books:")),
+                           ('checknotinlibrary_search',_("Deleted Books (not in Library):")),
+                           ('checknotondevice_search',_("Added Books (not on Device):"))]:
+            if key not in keys:
+                continue
+            warnings = check_search(self.plugin_action.gui, key, prefs[key])
+            if warnings:
+                det_msg.append('%s %s'%(label,prefs[key]))
+                det_msg.extend([ '    '+w for w in warnings ])
+        if det_msg:
+            info_dialog(self.plugin_action.gui, _('Slow Searches'),
+                        _('Some of the searches just saved may make ejecting slow.  See details.'),
+                        det_msg='\n'.join(det_msg),
+                        show=True,
+                        show_copy_button=True)
+
     def edit_shortcuts(self):
         self.save_settings()
         d = KeyboardConfigDialog(self.plugin_action.gui, self.plugin_action.action_spec[0])
@@ -234,10 +365,61 @@ class BasicTab(QWidget):
         self.sendnotondevice = QCheckBox(_('Send to Device?'),self)
         self.sendnotondevice.setToolTip(_('Send books in the current library that are not on the device.'))
         self.sendnotondevice.setChecked(prefs['sendnotondevice'])
-        self.sendnotondevice.setEnabled(self.checknotondevice.isChecked())
-        self.checknotondevice.stateChanged.connect(lambda x : self.sendnotondevice.setEnabled(self.checknotondevice.isChecked()))
         horz.addWidget(self.sendnotondevice)
 
+        self.preconvertnotondevice = QCheckBox(_('Convert Ahead?'),self)
+        self.preconvertnotondevice.setToolTip(_('While the device is connected, convert books that will be sent but have no format the device takes, so sending them is quicker.'))
+        self.preconvertnotondevice.setChecked(prefs['preconvertnotondevice'])
+        horz.addWidget(self.preconvertnotondevice)
+
+        def notondevice_enabled(x=None):
+            self.sendnotondevice.setEnabled(self.checknotondevice.isChecked())
+            self.preconvertnotondevice.setEnabled(self.checknotondevice.isChecked() and self.sendnotondevice.isChecked())
+        notondevice_enabled()
+        self.checknotondevice.stateChanged.connect(notondevice_enabled)
+        self.sendnotondevice.stateChanged.connect(notondevice_enabled)
+
+        horz.insertStretch(-1)
+        self.sl.addLayout(horz)
+
+        horz = QHBoxLayout()
+        self.checkstale = QCheckBox(_('Outdated Books (changed in Library)'),self)
+        self.checkstale.setToolTip(_('Check for books on the device whose file in the library has changed since it was sent.'))
+        self.checkstale.setChecked(prefs['checkstale'])
+        horz.addWidget(self.checkstale)
+
+        self.sendstale = QCheckBox(_('Send to Device?'),self)
+        self.sendstale.setToolTip(_('Send books on the device whose file in the library has changed since it was sent.'))
+        self.sendstale.setChecked(prefs['sendstale'])
+        horz.addWidget(self.sendstale)
+
+        self.stalehashes = QCheckBox(_('Compare Contents?'),self)
+        self.stalehashes.setToolTip(_('Keep a hash of each library file sent and compare contents before calling a book outdated.  Slower, but ignores files that were only touched.'))
+        self.stalehashes.setChecked(prefs['stalehashes'])
+        horz.addWidget(self.stalehashes)
+
+        def stale_enabled(x=None):
+            self.sendstale.setEnabled(self.checkstale.isChecked())
+            self.stalehashes.setEnabled(self.checkstale.isChecked())
+        stale_enabled()
+        self.checkstale.stateChanged.connect(stale_enabled)
+
+        horz.insertStretch(-1)
+        self.sl.addLayout(horz)
+
+        horz = QHBoxLayout()
+        self.checkmetadata = QCheckBox(_('Changed Metadata (title, series, tags, cover...)'),self)
+        self.checkmetadata.setToolTip(_('Check for books on the device whose title, authors, series, tags or cover have changed in the library since they were last put on the device.'))
+        self.checkmetadata.setChecked(prefs['checkmetadata'])
+        horz.addWidget(self.checkmetadata)
+
+        self.updatemetadata = QCheckBox(_('Update on Device?'),self)
+        self.updatemetadata.setToolTip(_('Update just the metadata on the device for books whose metadata has changed, without sending the books again.'))
+        self.updatemetadata.setChecked(prefs['updatemetadata'])
+        self.updatemetadata.setEnabled(self.checkmetadata.isChecked())
+        self.checkmetadata.stateChanged.connect(lambda x : self.updatemetadata.setEnabled(self.checkmetadata.isChecked()))
+        horz.addWidget(self.updatemetadata)
+
         horz.insertStretch(-1)
         self.sl.addLayout(horz)
 
@@ -246,6 +428,45 @@ class BasicTab(QWidget):
         self.stopsmartdevice.setChecked(prefs['stopsmartdevice'])
         self.sl.addWidget(self.stopsmartdevice)
 
+        self.ejectwhenidle = QCheckBox(_('Wait for device jobs to finish'),self)
+        self.ejectwhenidle.setToolTip(_('If device jobs (sending, deleting, syncing) are running, wait for them to finish, then check and eject.  Click SmartEject again while waiting to cancel.'))
+        self.ejectwhenidle.setChecked(prefs['ejectwhenidle'])
+        self.sl.addWidget(self.ejectwhenidle)
+
+        horz = QHBoxLayout()
+        self.prewarm = QCheckBox(_('Pre-check while idle'),self)
+        self.prewarm.setToolTip(_('While a device is connected and calibre is idle, do the checks a little at a time so ejecting is quicker.'))
+        self.prewarm.setChecked(prefs['prewarm'])
+        horz.addWidget(self.prewarm)
+
+        label = QLabel(_('Milliseconds per step:'))
+        horz.addWidget(label)
+        self.prewarmslicems = QSpinBox(self)
+        self.prewarmslicems.setRange(1,100)
+        self.prewarmslicems.setToolTip(_('How long each pre-check step may keep calibre busy.  Smaller is smoother, larger finishes sooner.'))
+        self.prewarmslicems.setValue(prefs['prewarmslicems'])
+        label.setBuddy(self.prewarmslicems)
+        horz.addWidget(self.prewarmslicems)
+
+        self.showprewarmprogress = QCheckBox(_('Show progress?'),self)
+        self.showprewarmprogress.setToolTip(_('Show pre-check progress in the status bar.'))
+        self.showprewarmprogress.setChecked(prefs['showprewarmprogress'])
+        horz.addWidget(self.showprewarmprogress)
+
+        def prewarm_enabled(x=None):
+            self.prewarmslicems.setEnabled(self.prewarm.isChecked())
+            self.showprewarmprogress.setEnabled(self.prewarm.isChecked())
+        prewarm_enabled()
+        self.prewarm.stateChanged.connect(prewarm_enabled)
+
+        horz.insertStretch(-1)
+        self.sl.addLayout(horz)
+
+        self.keepprecheck = QCheckBox(_('Keep check results when calibre restarts'),self)
+        self.keepprecheck.setToolTip(_("Save the checks' results in calibre's configuration folder and reuse them after calibre restarts if the library and device haven't changed."))
+        self.keepprecheck.setChecked(prefs['keepprecheck'])
+        self.sl.addWidget(self.keepprecheck)
+
         self.sl.insertStretch(-1)
 
         self.l.addSpacing(15)
@@ -265,10 +486,35 @@ class BasicTab(QWidget):
         view_prefs_button.clicked.connect(self.view_prefs)
         self.l.addWidget(view_prefs_button)
 
+        horz = QHBoxLayout()
+        self.profilenexteject = QCheckBox(_('Profile next eject'),self)
+        self.profilenexteject.setToolTip(_('Record where the time goes during the next SmartEject click, to send with a report of slow ejecting.'))
+        self.profilenexteject.setChecked(prefs['profilenexteject'])
+        horz.addWidget(self.profilenexteject)
+
+        view_profile_button = QPushButton(_('View last profile...'), self)
+        view_profile_button.setToolTip(_('View the profile saved by the last profiled eject'))
+        view_profile_button.clicked.connect(self.view_profile)
+        horz.addWidget(view_profile_button)
+        self.l.addLayout(horz)
+
     def view_prefs(self):
         d = PrefsViewerDialog(self.plugin_action.gui, PREFS_NAMESPACE)
         d.exec_()
 
+    def view_profile(self):
+        from calibre_plugins.smarteject.profiling import read_summary, profile_paths
+        summary = read_summary()
+        if summary is None:
+            info_dialog(self, _('No Profile'),
+                        _('There is no saved profile yet.  Check <i>Profile next eject</i>, save settings and click SmartEject.'),
+                        show=True,
+                        show_copy_button=False)
+            return
+        d = TextViewerDialog(self.plugin_action.gui, _('Last SmartEject Profile'), summary,
+                             note=_('Full profile saved in: %s')%profile_paths()[0])
+        d.exec_()
+
     def reset_dialogs(self):
         for key in dynamic.keys():
             if key.startswith('smarteject_') and key.endswith('_again') \
@@ -304,29 +550,37 @@ class SearchesTab(QWidget):
         scrollcontent.setLayout(self.sl)
 
 
-        self.sl.addWidget(QLabel(_("Search for Duplicated Books:")))
-        self.checkdups_search = QLineEdit(self)
-        self.sl.addWidget(self.checkdups_search)
-        # As of Calibre 5.42, the duplicate search needs to change.
-        # Automatically change it if it's the old default search.
-        if prefs['checkdups_search'] == 'ondevice:"("':
-            prefs['checkdups_search'] = default_prefs['checkdups_search']
-        self.checkdups_search.setText(prefs['checkdups_search'])
-        self.checkdups_search.setToolTip(_('Default is %s')%default_prefs['checkdups_search'])
-        self.sl.addSpacing(5)
-
-        self.sl.addWidget(QLabel(_("Deleted Books (not in Library):")))
-        self.checknotinlibrary_search = QLineEdit(self)
-        self.sl.addWidget(self.checknotinlibrary_search)
-        self.checknotinlibrary_search.setText(prefs['checknotinlibrary_search'])
-        self.checknotinlibrary_search.setToolTip(_('Default is %s')%default_prefs['checknotinlibrary_search'])
-        self.sl.addSpacing(5)
-
-        self.sl.addWidget(QLabel(_("Added Books (not on Device):")))
-        self.checknotondevice_search = QLineEdit(self)
-        self.sl.addWidget(self.checknotondevice_search)
-        self.checknotondevice_search.setText(prefs['checknotondevice_search'])
-        self.checknotondevice_search.setToolTip(_('Default is %s')%default_prefs['checknotondevice_search'])
+        self.counter = SearchCounter(self, plugin_action.gui)
+        self.counter.counted.connect(self.show_count)
+        self.count_labels = {}
+        self.count_timers = {}
+
+        for key, label in [('checkdups_search',_("Search for Duplicated Books:")),
+                           ('checknotinlibrary_search',_("Deleted Books (not in Library):")),
+                           ('checknotondevice_search',_("Added Books (not on Device):"))]:
+            if self.count_labels:
+                self.sl.addSpacing(5)
+            horz = QHBoxLayout()
+            horz.addWidget(QLabel(label))
+            horz.insertStretch(-1)
+            self.count_labels[key] = QLabel(self)
+            self.count_labels[key].setToolTip(_('How many books this search matches now, and how long it took.'))
+            horz.addWidget(self.count_labels[key])
+            self.sl.addLayout(horz)
+
+            edit = QLineEdit(self)
+            setattr(self, key, edit)
+            self.sl.addWidget(edit)
+            edit.setText(prefs[key])
+            edit.setToolTip(_('Default is %s')%default_prefs[key])
+
+            timer = QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(COUNT_DELAY_MS)
+            timer.timeout.connect(lambda key=key: self.count(key))
+            self.count_timers[key] = timer
+            edit.textChanged.connect(lambda x, timer=timer: timer.start())
+            self.count(key)
 
         self.sl.insertStretch(-1)
 
@@ -338,7 +592,277 @@ class SearchesTab(QWidget):
         self.l.addWidget(restore_defaults_button)
 
 
+    def count(self, key):
+        self.count_labels[key].setText(_('Counting...'))
+        self.counter.count(key, unicode(getattr(self, key).text()))
+
+    def show_count(self, key, search, count, seconds):
+        if search != unicode(getattr(self, key).text()):
+            # stale, the search has changed since.
+            return
+        if count is None:
+            self.count_labels[key].setText(_('Invalid search'))
+        else:
+            self.count_labels[key].setText(_('%s matches in %.2fs')%(count, seconds))
+
     def restore_defaults_button(self):
         self.checkdups_search.setText(default_prefs['checkdups_search'])
         self.checknotinlibrary_search.setText(default_prefs['checknotinlibrary_search'])
         self.checknotondevice_search.setText(default_prefs['checknotondevice_search'])
+
+class DevicesTab(QWidget):
+
+    def __init__(self, parent_dialog, plugin_action):
+        QWidget.__init__(self)
+        self.parent_dialog = parent_dialog
+        self.plugin_action = plugin_action
+        gui = plugin_action.gui
+
+        self.scopes = copy.deepcopy(prefs['device_scopes'])
+
+        # the connected device can be set up even if it isn't yet.
+        from calibre_plugins.smarteject.fingerprints import get_device_uuid
+        uuid = get_device_uuid(gui)
+        if uuid and uuid not in self.scopes:
+            self.scopes[uuid] = {'name':gui.device_manager.connected_device.get_gui_name(),
+                                 'type':'', 'value':''}
+
+        self.l = QVBoxLayout()
+        self.setLayout(self.l)
+
+        label = QLabel(_('Limit the Duplicated Books and Added Books checks for each device to the books meant for it.'))
+        label.setWordWrap(True)
+        self.l.addWidget(label)
+        self.l.addSpacing(5)
+
+        grid = QGridLayout()
+        self.l.addLayout(grid)
+
+        grid.addWidget(QLabel(_('Device:')), 0, 0)
+        self.device = QComboBox(self)
+        self.device.setToolTip(_('Devices are told apart by the id calibre keeps on them.  Connect a device to add it here.'))
+        for device_uuid, scope in sorted(self.scopes.items(), key=lambda x: (x[0] != uuid, x[1]['name'])):
+            name = scope['name']
+            if device_uuid == uuid:
+                name = _('%s (connected)')%name
+            self.device.addItem(name, device_uuid)
+        grid.addWidget(self.device, 0, 1)
+
+        grid.addWidget(QLabel(_('Limit to:')), 1, 0)
+        self.scope_type = QComboBox(self)
+        for scope_type, name in [('', _('Whole library')),
+                                 ('virtual_library', _('Virtual library')),
+                                 ('tag', _('Tag')),
+                                 ('saved_search', _('Saved search'))]:
+            self.scope_type.addItem(name, scope_type)
+        grid.addWidget(self.scope_type, 1, 1)
+
+        grid.addWidget(QLabel(_('Name:')), 2, 0)
+        self.scope_value = QComboBox(self)
+        self.scope_value.setEditable(True)
+        grid.addWidget(self.scope_value, 2, 1)
+        grid.setColumnStretch(1, 1)
+
+        self.forget_button = QPushButton(_('Forget Device'), self)
+        self.forget_button.setToolTip(_('Remove the selected device from this list.'))
+        self.forget_button.clicked.connect(self.forget_device)
+        self.l.addWidget(self.forget_button)
+
+        self.l.insertStretch(-1)
+
+        self.current_uuid = None
+        self.device.currentIndexChanged.connect(self.show_device)
+        self.scope_type.currentIndexChanged.connect(self.show_values)
+        self.show_device()
+
+    def store_current(self):
+        if self.current_uuid in self.scopes:
+            self.scopes[self.current_uuid]['type'] = unicode(self.scope_type.itemData(self.scope_type.currentIndex()) or '')
+            self.scopes[self.current_uuid]['value'] = unicode(self.scope_value.currentText()).strip()
+
+    def show_device(self, *args):
+        self.store_current()
+        self.current_uuid = self.device.itemData(self.device.currentIndex())
+        enabled = self.current_uuid in self.scopes
+        for w in (self.scope_type, self.scope_value, self.forget_button):
+            w.setEnabled(enabled)
+        if not enabled:
+            return
+        scope = self.scopes[self.current_uuid]
+        self.scope_type.blockSignals(True)
+        self.scope_type.setCurrentIndex(max(0, self.scope_type.findData(scope['type'])))
+        self.scope_type.blockSignals(False)
+        self.show_values()
+        self.scope_value.setEditText(scope['value'])
+
+    def show_values(self, *args):
+        db = self.plugin_action.gui.current_db
+        scope_type = self.scope_type.itemData(self.scope_type.currentIndex())
+        if scope_type == 'virtual_library':
+            values = db.prefs.get('virtual_libraries', {}).keys()
+        elif scope_type == 'tag':
+            values = db.all_tags()
+        elif scope_type == 'saved_search':
+            values = db.new_api.saved_search_names()
+        else:
+            values = []
+        self.scope_value.clear()
+        self.scope_value.addItems(sorted(values, key=lambda x: x.lower()))
+        self.scope_value.setEditText('')
+        self.scope_value.setEnabled(bool(scope_type))
+
+    def forget_device(self):
+        uuid = self.current_uuid
+        self.current_uuid = None
+        del self.scopes[uuid]
+        self.device.removeItem(self.device.currentIndex())
+
+    def get_scopes(self):
+        self.store_current()
+        # devices left on whole library don't need saving.
+        return dict([ (k, v) for k, v in self.scopes.items() if v['type'] and v['value'] ])
+
+class LibrariesTab(QWidget):
+
+    def __init__(self, parent_dialog, plugin_action):
+        QWidget.__init__(self)
+        self.parent_dialog = parent_dialog
+        self.plugin_action = plugin_action
+        current = plugin_action.gui.current_db.library_path
+
+        self.l = QVBoxLayout()
+        self.setLayout(self.l)
+
+        self.checkotherlibraries = QCheckBox(_('Deleted Books may be in other Libraries'),self)
+        self.checkotherlibraries.setToolTip(_("Don't count books on the device that are in one of the libraries checked below as not in Library.\n"
+                                              "Those libraries are read directly, without opening them."))
+        self.checkotherlibraries.setChecked(prefs['checkotherlibraries'])
+        self.l.addWidget(self.checkotherlibraries)
+
+        self.libraries = QListWidget(self)
+        # calibre's own list of libraries it has opened, plus any
+        # saved that it's since forgotten.
+        paths = set(gprefs.get('library_usage_stats', {}).keys())
+        paths.update(prefs['otherlibraries'])
+        for path in sorted(paths, key=lambda x: x.lower()):
+            if path == current:
+                continue
+            item = QListWidgetItem(path, self.libraries)
+            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if path in prefs['otherlibraries'] else Qt.Unchecked)
+        self.libraries.setEnabled(self.checkotherlibraries.isChecked())
+        self.checkotherlibraries.stateChanged.connect(lambda x : self.libraries.setEnabled(self.checkotherlibraries.isChecked()))
+        self.l.addWidget(self.libraries)
+
+    def get_libraries(self):
+        return [ unicode(self.libraries.item(i).text())
+                 for i in range(self.libraries.count())
+                 if self.libraries.item(i).checkState() == Qt.Checked ]
+
+class SearchCounter(QObject):
+    '''
+    Counts what searches match, remembering the answers for each search
+    until the library or device changes.
+
+    The device book lists can only be used on the GUI thread, so device
+    searches and the defaults, which are quick, are counted there.
+    Other library searches go to a single worker thread that only uses
+    db.new_api and counts just the latest search for each key.  Its
+    answers are picked up on the GUI thread by a timer.
+    '''
+    # key, search, count (None if the search failed), seconds
+    counted = pyqtSignal(object, object, object, object)
+
+    def __init__(self, parent, gui):
+        QObject.__init__(self, parent)
+        self.gui = gui
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        # key -> (rk, db, book ids, marked ids) waiting for the worker.
+        self.pending = {}
+        # (rk, result) from the worker, not yet passed on.
+        self.finished = []
+        self.working = False
+        self.cancelled = threading.Event()
+        self.timer = QTimer(self)
+        self.timer.setInterval(COUNT_POLL_MS)
+        self.timer.timeout.connect(self.deliver)
+        # stop the worker once the settings dialog is gone.
+        cancelled = self.cancelled
+        self.destroyed.connect(lambda *args: cancelled.set())
+
+    def stamp(self):
+        try:
+            return self.gui.iactions['SmartEject'].audit.current_stamp()
+        except Exception:
+            return None
+
+    def scope(self, key):
+        '''
+        (search, IdSet) of the books the eject check for key is limited
+        to on the connected device, so the counts agree with it.
+        '''
+        try:
+            audit = self.gui.iactions['SmartEject'].audit
+            return (audit.scope_search(), audit.scope(key))
+        except Exception:
+            return (None, None)
+
+    def count(self, key, search):
+        from calibre_plugins.smarteject.searches import (count_matches, time_call,
+                                                         is_library_search, library_candidates)
+        (scope_search, scope) = self.scope(key)
+        rk = (key, search, self.stamp(), scope_search if scope is not None else None)
+        if rk in self.results:
+            self.counted.emit(key, search, *self.results[rk])
+            return
+        if not is_library_search(key, search):
+            try:
+                result = time_call(count_matches, self.gui, key, search, scope)
+            except Exception:
+                result = (None, None)
+            self.remember(rk, result)
+            return
+        db = self.gui.current_db
+        job = (rk, db, library_candidates(db, scope), dict(db.data.marked_ids))
+        with self.lock:
+            # replaces any older search for key not started yet.
+            self.pending[key] = job
+            start = not self.working
+            self.working = True
+        if start:
+            thread = threading.Thread(target=self.work, name='SmartEject search count')
+            thread.daemon = True
+            thread.start()
+        self.timer.start()
+
+    def work(self):
+        from calibre_plugins.smarteject.searches import matching_book_ids, time_call
+        while not self.cancelled.is_set():
+            with self.lock:
+                if not self.pending:
+                    self.working = False
+                    return
+                (key, (rk, db, book_ids, marked_ids)) = self.pending.popitem()
+            try:
+                (found, seconds) = time_call(matching_book_ids, db, rk[1], book_ids, marked_ids)
+                result = (len(found), seconds)
+            except Exception:
+                result = (None, None)
+            with self.lock:
+                self.finished.append((rk, result))
+
+    def deliver(self):
+        with self.lock:
+            finished = self.finished
+            self.finished = []
+            if not self.working:
+                self.timer.stop()
+        for rk, result in finished:
+            self.remember(rk, result)
+
+    def remember(self, rk, result):
+        self.results[rk] = result
+        while len(self.results) > MAX_COUNTS:
+            self.results.popitem(last=False)
+        self.counted.emit(rk[0], rk[1], *result)
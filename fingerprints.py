@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import os, json, calendar, hashlib
+from multiprocessing.pool import ThreadPool
+
+from calibre.utils.config import JSONConfig
+
+from calibre_plugins.smarteject.idset import IdSet
+
+# Threads used to hash files.  Reading files and hashlib both let
+# other threads run, so this doesn't hold up the GUI much.
+HASH_THREADS = 4
+
+HASH_BLOCK = 1024*1024
+
+# Library fields calibre puts on the device with a book.  cover is
+# handled separately.
+METADATA_FIELDS = ['title', 'authors', 'series', 'series_index', 'tags']
+
+def get_device_uuid(gui):
+    '''
+    The uuid calibre keeps on the connected device's main memory, or
+    None if there isn't one.
+    '''
+    try:
+        return gui.device_manager.connected_device.driveinfo['main']['device_store_uuid']
+    except:
+        return None
+
+def device_cache(gui, name):
+    '''
+    JSONConfig stored under the plugin's config dir for the connected
+    device, or None if the device has no uuid.
+    '''
+    uuid = get_device_uuid(gui)
+    if not uuid:
+        return None
+    return JSONConfig('plugins/SmartEject/%s/%s'%(name,uuid))
+
+def device_fingerprint(book):
+    try:
+        mtime = calendar.timegm(book.datetime)
+    except:
+        mtime = None
+    return [getattr(book, 'size', None), mtime]
+
+def library_fingerprint(db, book_id, fmt):
+    '''
+    Returns ([size, mtime], path) of the library's fmt file for
+    book_id or (None, None) if it doesn't have one.
+    '''
+    try:
+        fm = db.new_api.format_metadata(book_id, fmt)
+    except:
+        fm = None
+    if not fm or 'path' not in fm:
+        return (None, None)
+    return ([fm['size'], calendar.timegm(fm['mtime'].utctimetuple())], fm['path'])
+
+def file_hash(path):
+    try:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                h.update(block)
+        return h.hexdigest()
+    except (IOError, OSError):
+        return None
+
+def hash_files(paths):
+    '''
+    Returns file_hash() of each of paths, hashed in a thread pool.
+    '''
+    if not paths:
+        return []
+    pool = ThreadPool(HASH_THREADS)
+    try:
+        return pool.map(file_hash, paths)
+    finally:
+        pool.close()
+
+def find_stale(gui, use_hashes=False):
+    '''
+    Returns an IdSet of library book ids whose library file has changed
+    since the copy on the device was sent.
+
+    For each device book, the fingerprint (size, mtime) of both the
+    device file and the matching library format are kept per device.
+    A device copy seen for the first time, or whose own fingerprint
+    changed (it was resent), is taken to be current.  After that, a
+    change to the library fingerprint makes it stale.
+
+    With use_hashes, a hash of the library file is kept too, taken
+    while its fingerprint is still the one sent.  Stale candidates are
+    hashed again in a thread pool and dropped if the library file's
+    contents haven't actually changed.  (The device file can't be
+    compared directly, calibre writes metadata into the copy it
+    sends.)
+    '''
+    cache = device_cache(gui, 'fingerprints')
+    if cache is None or not gui.device_manager.is_device_connected:
+        return IdSet()
+    db = gui.library_view.model().db
+    old = cache.get('books', {})
+    new = {}
+    candidates = {}
+    # lpath -> library path of entries that need a baseline hash.
+    unhashed = {}
+    for booklist in gui.booklists():
+        for book in booklist:
+            book_id = getattr(book, 'application_id', None)
+            lpath = getattr(book, 'lpath', None)
+            if book_id is None or not lpath:
+                continue
+            fmt = os.path.splitext(lpath)[1][1:].upper()
+            (libfp, libpath) = library_fingerprint(db, book_id, fmt)
+            if libfp is None:
+                continue
+            devfp = device_fingerprint(book)
+            entry = old.get(lpath)
+            if entry is None or entry['id'] != book_id or entry['dev'] != devfp:
+                entry = {'id':book_id, 'dev':devfp, 'lib':libfp}
+            elif entry['lib'] != libfp:
+                candidates[lpath] = (book_id, libfp, libpath)
+            if use_hashes and 'hash' not in entry and entry['lib'] == libfp:
+                # the library file is still the one sent.
+                unhashed[lpath] = libpath
+            new[lpath] = entry
+
+    if use_hashes:
+        lpaths = list(unhashed.keys())
+        for lpath, h in zip(lpaths, hash_files([ unhashed[lpath] for lpath in lpaths ])):
+            if h is not None:
+                new[lpath]['hash'] = h
+        lpaths = [ lpath for lpath in candidates if new[lpath].get('hash') ]
+        for lpath, h in zip(lpaths, hash_files([ candidates[lpath][2] for lpath in lpaths ])):
+            if h == new[lpath]['hash']:
+                # only the library file's mtime changed.
+                new[lpath]['lib'] = candidates[lpath][1]
+                del candidates[lpath]
+
+    cache['books'] = new
+    return IdSet([ book_id for (book_id, libfp, libpath) in candidates.values() ])
+
+def metadata_hash(values):
+    '''
+    Short hash of the METADATA_FIELDS values in values, normalized so a
+    library book and its device copy hash the same when they match.
+    '''
+    (title, authors, series, series_index, tags) = values
+    if series:
+        series_index = float(series_index or 0)
+    else:
+        series = series_index = None
+    normalized = [title or '', list(authors or []), series, series_index,
+                  sorted(tags or [])]
+    return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()[:16]
+
+def metadata_hashes(db, book_ids):
+    '''
+    Returns a dict of book_id to metadata_hash() of each library book
+    in book_ids.
+    '''
+    api = db.new_api
+    book_ids = list(book_ids)
+    values = [ api.all_field_for(field, book_ids) for field in METADATA_FIELDS ]
+    return dict([ (book_id, metadata_hash([ v.get(book_id) for v in values ]))
+                  for book_id in book_ids ])
+
+def device_metadata_hash(book):
+    '''
+    metadata_hash() of what's on the device for device book.
+    '''
+    return metadata_hash([ getattr(book, field, None) for field in METADATA_FIELDS ])
+
+def cover_times(db, book_ids):
+    '''
+    Returns a dict of book_id to when its library cover last changed,
+    as a string.
+    '''
+    times = {}
+    for book_id in book_ids:
+        try:
+            times[book_id] = '%s'%db.new_api.cover_last_modified(book_id)
+        except:
+            times[book_id] = None
+    return times
+
+def device_books_by_id(gui):
+    '''
+    Returns a dict of library book id to list of (lpath, device
+    fingerprint, device_metadata_hash()) on the device.
+    '''
+    books = {}
+    if gui.device_manager.is_device_connected:
+        for booklist in gui.booklists():
+            for book in booklist:
+                book_id = getattr(book, 'application_id', None)
+                lpath = getattr(book, 'lpath', None)
+                if book_id is not None and lpath:
+                    books.setdefault(book_id, []).append((lpath, device_fingerprint(book),
+                                                          device_metadata_hash(book)))
+    return books
+
+def find_outdated_metadata(gui):
+    '''
+    Returns an IdSet of library book ids whose device relevant metadata
+    differs from what's on the device.
+
+    The device book lists carry the metadata fields themselves, so
+    those are compared directly with the library.  Covers aren't, so
+    when the library cover last changed is kept per device book.  A
+    device book seen for the first time, or whose file has changed (it
+    was resent), is taken to have the current cover.
+    '''
+    books = device_books_by_id(gui)
+    db = gui.library_view.model().db
+    hashes = metadata_hashes(db, books.keys())
+    outdated = set([ book_id for book_id, copies in books.items()
+                     if any([ devhash != hashes[book_id] for (lpath, devfp, devhash) in copies ]) ])
+
+    cache = device_cache(gui, 'covers')
+    if cache is not None:
+        covers = cover_times(db, books.keys())
+        old = cache.get('books', {})
+        new = {}
+        for book_id, copies in books.items():
+            for (lpath, devfp, devhash) in copies:
+                entry = old.get(lpath)
+                if entry is None or entry[0] != book_id or entry[2] != devfp:
+                    entry = [book_id, covers[book_id], devfp]
+                elif entry[1] != covers[book_id]:
+                    outdated.add(book_id)
+                new[lpath] = entry
+        cache['books'] = new
+    return IdSet(outdated)
+
+def mark_metadata_current(gui, book_ids):
+    '''
+    Record the current covers of book_ids as what's on the device.
+    '''
+    cache = device_cache(gui, 'covers')
+    if cache is None:
+        return
+    books = device_books_by_id(gui)
+    book_ids = [ book_id for book_id in book_ids if book_id in books ]
+    covers = cover_times(gui.library_view.model().db, book_ids)
+    entries = cache.get('books', {})
+    for book_id in book_ids:
+        for (lpath, devfp, devhash) in books[book_id]:
+            entries[lpath] = [book_id, covers[book_id], devfp]
+    cache['books'] = entries
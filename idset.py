@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+from binascii import hexlify, unhexlify
+
+def bits_from_ids(ids):
+    '''
+    Returns a Python int with bit n set for each n in ids.
+    '''
+    ids = list(ids)
+    if not ids:
+        return 0
+    ba = bytearray(max(ids)//8+1)
+    for i in ids:
+        ba[i>>3] |= 1 << (i&7)
+    # little endian bytes -> int
+    ba.reverse()
+    return int(hexlify(bytes(ba)), 16)
+
+def bytes_from_bits(bits):
+    '''
+    Little endian bytes of bits, the reverse of bits_from_bytes().
+    '''
+    if not bits:
+        return b''
+    h = '%x'%bits
+    if len(h)%2:
+        h = '0'+h
+    ba = bytearray(unhexlify(h))
+    ba.reverse()
+    return bytes(ba)
+
+def bits_from_bytes(data):
+    if not data:
+        return 0
+    ba = bytearray(data)
+    ba.reverse()
+    return int(hexlify(bytes(ba)), 16)
+
+class IdSet(object):
+    '''
+    A set of small non-negative ints (book ids, device book list
+    indexes) kept as a bitmap in a single Python int.  A library's
+    worth of ids takes a few tens of KB instead of tens of MB, and
+    union, intersection, difference, emptiness and count are done in C
+    on the whole bitmap at once.
+    '''
+    __slots__ = ('bits', 'cache')
+
+    def __init__(self, ids=()):
+        if isinstance(ids, IdSet):
+            self.bits = ids.bits
+        else:
+            self.bits = bits_from_ids(ids)
+        # bytearray of the bits, made on first lookup.
+        self.cache = None
+
+    @classmethod
+    def from_bits(cls, bits):
+        s = cls()
+        s.bits = bits
+        return s
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls.from_bits(bits_from_bytes(data))
+
+    def to_bytes(self):
+        return bytes_from_bits(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+    __nonzero__ = __bool__
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def lookup_bytes(self):
+        if self.cache is None:
+            self.cache = bytearray(self.to_bytes())
+        return self.cache
+
+    def __contains__(self, i):
+        # one byte of the bitmap instead of shifting all of it.
+        data = self.lookup_bytes()
+        return 0 <= i < len(data)*8 and bool(data[i >> 3] & (1 << (i & 7)))
+
+    def __iter__(self):
+        for byteno, byte in enumerate(self.lookup_bytes()):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield byteno*8 + bit
+
+    def __or__(self, other):
+        return IdSet.from_bits(self.bits | IdSet(other).bits)
+
+    def __and__(self, other):
+        return IdSet.from_bits(self.bits & IdSet(other).bits)
+
+    def __sub__(self, other):
+        return IdSet.from_bits(self.bits & ~IdSet(other).bits)
+
+    def __eq__(self, other):
+        return isinstance(other, IdSet) and self.bits == other.bits
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __repr__(self):
+        return 'IdSet(%d ids)'%len(self)
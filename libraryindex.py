@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import os, json, zlib, sqlite3, threading, traceback
+
+from calibre.utils.config import config_dir
+
+from calibre_plugins.smarteject.idset import IdSet
+
+# Identifier types used to recognize a book from another library when
+# its uuid doesn't match.
+IDENTIFIER_TYPES = ('isbn', 'calibre', 'mobi-asin', 'amazon', 'google', 'url')
+
+# Book ids fetched per query when only some books changed.
+QUERY_CHUNK = 500
+
+def index_path():
+    return os.path.join(config_dir, 'plugins', 'SmartEject', 'library_index.json.z')
+
+def connect_readonly(dbpath):
+    try:
+        from six.moves.urllib.request import pathname2url
+        return sqlite3.connect('file:%s?mode=ro'%pathname2url(dbpath), uri=True)
+    except TypeError:
+        # python 2 sqlite3 has no uri; only ever read from anyway.
+        return sqlite3.connect(dbpath)
+
+def book_keys(uuid, identifiers):
+    '''
+    The strings a book is recognized by: its uuid and its identifiers
+    of IDENTIFIER_TYPES, as type:value.
+    '''
+    keys = []
+    if uuid:
+        keys.append('uuid:'+uuid)
+    for typ, val in identifiers.items():
+        if typ in IDENTIFIER_TYPES and val:
+            keys.append('%s:%s'%(typ, val.lower()))
+    return keys
+
+class LibraryIndex(object):
+    '''
+    Compact index of the uuids and identifiers of the books in other
+    calibre libraries, read directly from their metadata.db files
+    without opening them in calibre.  Kept in the config dir and
+    brought up to date by each library's metadata.db modification time
+    and the books' last_modified.
+
+    refresh() only touches sqlite and the index, so it can run in
+    another thread; see start_refresh().
+    '''
+    def __init__(self):
+        # library path -> {'mtime':..., 'books':{id:[last_modified, [keys]]}}
+        self.libraries = None
+        # every key of every indexed book.
+        self.keys = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def load(self):
+        if self.libraries is not None:
+            return
+        self.libraries = {}
+        try:
+            with open(index_path(), 'rb') as f:
+                self.libraries = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except Exception:
+            pass
+
+    def save(self):
+        path = index_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        data = zlib.compress(json.dumps(self.libraries, separators=(',',':')).encode('utf-8'))
+        tmp = path+'.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+
+    def stamp(self, library_paths):
+        '''
+        Changes whenever any of the libraries' metadata.db does.
+        '''
+        stamps = []
+        for path in library_paths:
+            try:
+                stamps.append((path, os.stat(os.path.join(path, 'metadata.db')).st_mtime))
+            except OSError:
+                stamps.append((path, None))
+        return tuple(stamps)
+
+    def start_refresh(self, library_paths):
+        '''
+        Run refresh() in a background thread unless one is already
+        running.  refreshing() says when it's done.
+        '''
+        if self.refreshing():
+            return
+        self.thread = threading.Thread(target=self.refresh, args=(list(library_paths),),
+                                       name='SmartEject library index')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def refreshing(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_current(self, library_paths):
+        '''
+        True if the index is up to date for library_paths, so filter()
+        can be used without refreshing first.
+        '''
+        if self.keys is None or self.refreshing():
+            return False
+        libraries = self.libraries
+        if [ path for path in libraries if path not in library_paths ]:
+            return False
+        for path, mtime in self.stamp(library_paths):
+            if mtime is not None and (path not in libraries or libraries[path]['mtime'] != mtime):
+                return False
+        return True
+
+    def refresh(self, library_paths):
+        '''
+        Bring the index up to date for library_paths, dropping any other
+        libraries.
+        '''
+        with self.lock:
+            self._refresh(library_paths)
+
+    def _refresh(self, library_paths):
+        self.load()
+        changed = False
+        for path in list(self.libraries.keys()):
+            if path not in library_paths:
+                del self.libraries[path]
+                changed = True
+        for path in library_paths:
+            dbpath = os.path.join(path, 'metadata.db')
+            try:
+                mtime = os.stat(dbpath).st_mtime
+            except OSError:
+                continue
+            entry = self.libraries.get(path)
+            if entry and entry['mtime'] == mtime:
+                continue
+            try:
+                books = self.read_library(dbpath, entry['books'] if entry else {})
+            except Exception:
+                # not read again until it changes.
+                traceback.print_exc()
+                books = {}
+            self.libraries[path] = {'mtime':mtime, 'books':books}
+            changed = True
+        if changed or self.keys is None:
+            allkeys = set()
+            for entry in self.libraries.values():
+                for (last_modified, keys) in entry['books'].values():
+                    allkeys.update(keys)
+            self.keys = allkeys
+        if changed:
+            self.save()
+
+    def read_library(self, dbpath, old_books):
+        '''
+        Returns the books dict for dbpath, only reading uuids and
+        identifiers for books added or modified since old_books.
+        '''
+        conn = connect_readonly(dbpath)
+        try:
+            books = {}
+            todo = []
+            for book_id, uuid, last_modified in conn.execute('SELECT id, uuid, last_modified FROM books'):
+                key = '%d'%book_id
+                old = old_books.get(key)
+                if old and old[0] == last_modified:
+                    books[key] = old
+                else:
+                    books[key] = [last_modified, [uuid]]
+                    todo.append(book_id)
+            for i in range(0, len(todo), QUERY_CHUNK):
+                chunk = todo[i:i+QUERY_CHUNK]
+                identifiers = {}
+                for book_id, typ, val in conn.execute(
+                        'SELECT book, type, val FROM identifiers WHERE book IN (%s)'%','.join(['?']*len(chunk)),
+                        chunk):
+                    identifiers.setdefault(book_id, {})[typ] = val
+                for book_id in chunk:
+                    key = '%d'%book_id
+                    books[key][1] = book_keys(books[key][1][0], identifiers.get(book_id, {}))
+            return books
+        finally:
+            conn.close()
+
+    def contains(self, book):
+        '''
+        True if device book is in one of the indexed libraries.
+        '''
+        return bool(self.keys) and \
+            bool(self.keys.intersection(book_keys(getattr(book, 'uuid', None),
+                                                  getattr(book, 'identifiers', None) or {})))
+
+    def filter(self, booklist, indexes):
+        '''
+        IdSet of the indexes into booklist of books not in any indexed
+        library.
+        '''
+        return IdSet([ i for i in indexes if not self.contains(booklist[i]) ])
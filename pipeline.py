@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+# Stage classes in registration order.
+stage_classes = []
+
+def register_stage(cls):
+    '''
+    Add a Stage subclass to the checks SmartEject makes before
+    ejecting.  Other plugins can add their own checks with:
+
+        from calibre_plugins.smarteject.pipeline import Stage, register_stage
+
+        class MyStage(Stage):
+            name = 'mycheck'
+            cost = 50
+            after = ('readinglist',)
+            ...
+        register_stage(MyStage)
+
+    Can be used as a class decorator.
+    '''
+    if cls.name in [ c.name for c in stage_classes ]:
+        raise ValueError('SmartEject stage %s already registered'%cls.name)
+    stage_classes.append(cls)
+    return cls
+
+class Stage(object):
+    '''
+    One check SmartEject makes before ejecting.
+
+    name: unique name, used by other stages' after.
+    cost: rough relative cost of check(); cheaper stages run first.
+    after: names of stages that must run before this one, usually
+        because they can change what this one would find.  Unknown or
+        disabled names are ignored.
+    depends: what the stage's answer depends on, any of 'library' and
+        'device'.  Once a stage is resolved (nothing found, or the user
+        answered), later clicks skip it until one of these changes.
+        None means always run it.
+    '''
+    name = None
+    cost = 100
+    after = ()
+    depends = ('library', 'device')
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.gui = plugin.gui
+        self.audit = plugin.audit
+
+    def enabled(self):
+        '''
+        Whether this check is turned on.
+        '''
+        return True
+
+    def known(self):
+        '''
+        True if check() already has its answer cached, making it free.
+        '''
+        return False
+
+    def current_cost(self):
+        return 0 if self.known() else self.cost
+
+    def check(self):
+        '''
+        Return a true value if there is something to ask the user about.
+        '''
+        raise NotImplementedError()
+
+    def act(self, result):
+        '''
+        Called with check()'s result when true.  Ask the user and do
+        whatever they chose.  Return True to stop here instead of
+        ejecting.
+        '''
+        raise NotImplementedError()
+
+    def searches(self):
+        '''
+        Searches this stage may leave in the search box, cleared again
+        after ejecting.
+        '''
+        return []
+
+def ordered_stages(stages):
+    '''
+    Order stages cheapest first, except that each stage comes after
+    the stages named in its after.
+    '''
+    names = set([ s.name for s in stages ])
+    remaining = list(stages)
+    done = set()
+    ordered = []
+    while remaining:
+        ready = [ s for s in remaining
+                  if all([ a in done or a not in names for a in s.after ]) ]
+        if not ready:
+            # dependency loop; fall back to registration order.
+            ready = remaining
+        # min() keeps registration order between equal costs.
+        stage = min(ready, key=lambda s: s.current_cost())
+        remaining.remove(stage)
+        done.add(stage.name)
+        ordered.append(stage)
+    return ordered
+
+def run_stages(stages, audit):
+    '''
+    Run the enabled stages in order, stopping at the first one whose
+    act() says to.  Returns True if a stage stopped the eject.
+
+    Stages resolved by an earlier click are skipped if nothing they
+    depend on has changed since, so after an action the next click
+    picks up where this one left off.
+    '''
+    for stage in ordered_stages([ s for s in stages if s.enabled() ]):
+        stamp = None
+        if stage.depends is not None:
+            stamp = audit.stamp_for(stage.depends)
+            if audit.resolved.get(stage.name) == stamp:
+                continue
+        result = stage.check()
+        stop = bool(result) and stage.act(result)
+        if stamp is not None:
+            # as of before the check, so anything act() changed gets
+            # checked again.
+            audit.resolved[stage.name] = stamp
+        if stop:
+            return True
+    # all done, next time starts over.
+    audit.resolved = {}
+    return False
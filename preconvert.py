@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+from calibre_plugins.smarteject.common_utils import get_library_uuid
+
+# Most conversions queued per library while calibre runs, so
+# connecting a new device to a big library doesn't bury calibre in
+# conversion jobs.
+MAX_QUEUED = 25
+
+# Books looked at per formats lookup.
+CHUNK = 500
+
+def device_formats(gui):
+    '''
+    Formats the connected device accepts, most preferred first,
+    lowercase.
+    '''
+    try:
+        return [ f.lower() for f in gui.device_manager.device.settings().format_map ]
+    except:
+        return []
+
+def output_format(gui):
+    '''
+    The device format calibre would convert to when sending, or None.
+    '''
+    from calibre.customize.ui import available_output_formats
+    outputs = set([ f.lower() for f in available_output_formats() ])
+    for fmt in device_formats(gui):
+        if fmt in outputs:
+            return fmt
+    return None
+
+class PreConverter(object):
+    '''
+    Queues conversions to a device format for library books that will
+    be sent by the not on device check but don't have any format the
+    device takes, so sending them later is just a copy.  Each book is
+    only queued once, and at most MAX_QUEUED per library, while calibre
+    runs.
+    '''
+    def __init__(self, gui):
+        self.gui = gui
+        self.libraryid = None
+        self.queued = set()
+
+    def needs_conversion(self, book_ids):
+        formats = set(device_formats(self.gui))
+        if not formats:
+            return []
+        db = self.gui.library_view.model().db
+        book_formats = db.new_api.all_field_for('formats', book_ids)
+        return [ book_id for book_id in book_ids
+                 if book_formats.get(book_id) and
+                 not formats & set([ f.lower() for f in book_formats[book_id] ]) ]
+
+    def queue(self, book_ids):
+        '''
+        Queue conversions for those of book_ids that need one.  Returns
+        the number queued.
+        '''
+        db = self.gui.library_view.model().db
+        libraryid = get_library_uuid(db)
+        if libraryid != self.libraryid:
+            self.libraryid = libraryid
+            self.queued = set()
+        of = output_format(self.gui)
+        room = MAX_QUEUED - len(self.queued)
+        if of is None or room <= 0:
+            return 0
+        needed = []
+        chunk = []
+        for book_id in book_ids:
+            if book_id not in self.queued:
+                chunk.append(book_id)
+            if len(chunk) >= CHUNK:
+                needed.extend(self.needs_conversion(chunk))
+                chunk = []
+                if len(needed) >= room:
+                    break
+        if chunk:
+            needed.extend(self.needs_conversion(chunk))
+        needed = needed[:room]
+        if not needed:
+            return 0
+        self.queued.update(needed)
+
+        # Same as calibre's own auto convert on add.
+        from calibre.gui2.tools import convert_single_ebook
+        convert_action = self.gui.iactions['Convert Books']
+        previous = self.gui.library_view.currentIndex()
+        jobs, changed, bad = convert_single_ebook(self.gui, db, needed, True, of,
+                                                  show_no_format_warning=False)
+        if not jobs:
+            return 0
+        convert_action.queue_convert_jobs(jobs, changed, bad, list(needed), previous,
+                                          convert_action.book_converted, rows_are_ids=True)
+        return len(jobs)
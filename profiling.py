@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import os, io, time, cProfile, pstats
+
+from calibre.utils.config import config_dir
+
+# How many functions to list in the summary.
+TOP_N = 40
+
+def profile_paths():
+    '''
+    Returns (stats file, summary file) paths for the saved profile.
+    '''
+    base = os.path.join(config_dir, 'plugins', 'SmartEject')
+    if not os.path.isdir(base):
+        os.makedirs(base)
+    return (os.path.join(base, 'eject.prof'),
+            os.path.join(base, 'eject-profile.txt'))
+
+def run_profiled(func, *args):
+    '''
+    Call func(*args) under cProfile, saving the raw stats and a top
+    TOP_N summary by cumulative time.  Note the times include any time
+    spent waiting for the user to answer dialogs.
+    '''
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        elapsed = time.time() - start
+        (statsfile, summaryfile) = profile_paths()
+        profiler.dump_stats(statsfile)
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        out.write(str('SmartEject eject profile, %s, %.3f seconds wall time\n\n'%(time.ctime(), elapsed)))
+        stats = pstats.Stats(statsfile, stream=out)
+        stats.sort_stats('cumulative').print_stats(TOP_N)
+        with io.open(summaryfile, 'w', encoding='utf-8') as f:
+            summary = out.getvalue()
+            if isinstance(summary, bytes):
+                summary = summary.decode('utf-8', 'replace')
+            f.write(summary)
+
+def read_summary():
+    '''
+    Text of the last saved profile summary, or None.
+    '''
+    summaryfile = profile_paths()[1]
+    if not os.path.exists(summaryfile):
+        return None
+    with io.open(summaryfile, 'r', encoding='utf-8') as f:
+        return f.read()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import re, time
+
+from calibre_plugins.smarteject.config import default_prefs
+from calibre_plugins.smarteject.idset import IdSet
+
+# pulls in translation files for _() strings
+try:
+    load_translations()
+except NameError:
+    pass # load_translations() added in calibre 1.9
+
+# Searches taking longer than this (in seconds) against the current
+# library are reported when settings are saved.
+SLOW_SEARCH_SECONDS = 1.0
+
+# More than this many regex terms in one search is reported as
+# expensive even when it happens to run fast on the current library.
+MAX_REGEX_TERMS = 3
+
+# Other spellings of the default searches that mean the same thing.
+# SmartEject evaluates the default searches directly from the device
+# book lists instead of running calibre's search, so these are worth
+# replacing with the default.  Compared after normalize_search().
+EQUIVALENT_SEARCHES = {
+    'checkdups_search':[r'ondevice:~\(',
+                        ],
+    'checknotinlibrary_search':['inlibrary:"false"',
+                                'not inlibrary:true',
+                                'not inlibrary:"true"',
+                                ],
+    'checknotondevice_search':[r'not ondevice:~[a-z]',
+                               'ondevice:false',
+                               'ondevice:"false"',
+                               'not ondevice:true',
+                               'not ondevice:"true"',
+                               ],
+    }
+
+# First chunk of books searched when only looking for any match.  Each
+# chunk after is twice the size of the last, so a search with no
+# matches costs little more than searching everything at once.
+FIRST_ANY_CHUNK = 256
+
+# field:value terms, value optionally quoted.
+term_re = re.compile(r'(?P<field>#?[\w]+):(?P<value>"(?:[^"\\]|\\.)*"|[^\s()]+)',
+                     re.UNICODE)
+
+def normalize_search(search):
+    '''
+    Collapse whitespace and case so trivially different spellings of
+    the same search compare equal.
+    '''
+    return ' '.join(search.split()).lower()
+
+def is_native_search(key, search):
+    '''
+    True if search is the default search for key, which SmartEject can
+    evaluate without calling calibre's search.
+    '''
+    return normalize_search(search) == normalize_search(default_prefs[key])
+
+def suggest_native(key, search):
+    '''
+    Returns the default search for key if search is an equivalent
+    spelling of it, otherwise None.
+    '''
+    if not is_native_search(key, search) and \
+            normalize_search(search) in EQUIVALENT_SEARCHES.get(key,[]):
+        return default_prefs[key]
+    return None
+
+def analyze_search(search):
+    '''
+    Return a list of human readable warnings about constructs in search
+    that are expensive to evaluate over every book in a library.
+    '''
+    warnings = []
+    regex_terms = 0
+    for m in term_re.finditer(search):
+        field = m.group('field').lower()
+        value = m.group('value').strip('"')
+        if field == 'template':
+            warnings.append(_('%s evaluates a template for every book.')%m.group(0))
+        elif field == 'search':
+            warnings.append(_('%s runs another saved search, which may itself be expensive.')%m.group(0))
+        if value.startswith('~'):
+            regex_terms += 1
+            if re.match(r'~\.[*+]', value) or re.search(r'\.[*+]\.[*+]', value):
+                warnings.append(_('%s uses a regular expression with unanchored wildcards, which can backtrack heavily.')%m.group(0))
+    if regex_terms > MAX_REGEX_TERMS:
+        warnings.append(_('Search uses %s regular expressions; each is checked against every book.')%regex_terms)
+    # Any word not part of a field:value term searches all fields.
+    bare = term_re.sub(' ',search)
+    bare = re.sub(r'\b(and|or|not)\b|[()]',' ',bare,flags=re.IGNORECASE)
+    if bare.strip():
+        warnings.append(_('"%s" is not restricted to a field and searches every field of every book.')%bare.strip())
+    return warnings
+
+def time_call(func, *args):
+    '''
+    Returns (result, seconds) for func(*args).
+    '''
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def iter_device_ids(gui):
+    '''
+    Yields the library book id of every book on the connected device
+    that calibre has matched to the library, once per copy.
+    '''
+    if not gui.device_manager.is_device_connected:
+        return
+    for booklist in gui.booklists():
+        for book in booklist:
+            book_id = getattr(book, 'application_id', None)
+            if book_id is not None:
+                yield book_id
+
+def device_ids_in_library(gui):
+    '''
+    Returns a dict of library book id to how many times that book is on
+    the connected device, over all locations, from the device book
+    lists calibre already matched against the library.
+    '''
+    counts = {}
+    for book_id in iter_device_ids(gui):
+        counts[book_id] = counts.get(book_id, 0) + 1
+    return counts
+
+def library_ids(db, scope=None):
+    '''
+    IdSet of the library's book ids, limited to the current virtual
+    library and to scope if given.
+    '''
+    ids = IdSet(db.search_getting_ids('', None))
+    if scope is not None:
+        ids = ids & scope
+    return ids
+
+def library_candidates(db, scope=None):
+    '''
+    List of the library's book ids, limited to the current virtual
+    library and to scope if given, for searching a chunk at a time
+    without building an IdSet of the whole library first.
+    '''
+    ids = db.search_getting_ids('', None)
+    if scope is not None:
+        scope = set(scope)
+        ids = [ book_id for book_id in ids if book_id in scope ]
+    return ids
+
+def native_dups(gui, db, counts=None, scope=None):
+    '''
+    Same as the default checkdups_search, ondevice:"~\\(".  calibre
+    counts a book's copies over all the device's book lists and adds
+    "(n books)" to its ondevice column when there's more than one, so
+    one copy in main memory and one on a card is a duplicate too.
+    '''
+    if counts is None:
+        counts = device_ids_in_library(gui)
+    return library_ids(db, scope) & IdSet([ book_id for book_id, c in counts.items() if c > 1 ])
+
+def native_notondevice(gui, db, counts=None, scope=None):
+    '''
+    Same as the default checknotondevice_search, not
+    ondevice:"~[a-z]".  The ondevice column is empty exactly when no
+    copy of the book is in any of the device's book lists.
+    '''
+    if counts is None:
+        counts = device_ids_in_library(gui)
+    return library_ids(db, scope) - IdSet(counts)
+
+def is_notinlibrary(book):
+    return not getattr(book, 'in_library', None)
+
+def native_notinlibrary(model):
+    '''
+    Same as the default checknotinlibrary_search, as indexes into
+    model.db, the device book list.
+    '''
+    return IdSet([ i for i, book in enumerate(model.db) if is_notinlibrary(book) ])
+
+native_library_searches = {
+    'checkdups_search':native_dups,
+    'checknotondevice_search':native_notondevice,
+    }
+
+def search_book_ids(db, search, book_ids, marked_ids=None):
+    '''
+    IdSet of matching_book_ids().
+    '''
+    return IdSet(matching_book_ids(db, search, book_ids, marked_ids))
+
+def matching_book_ids(db, search, book_ids, marked_ids=None):
+    '''
+    Returns the set of ids among book_ids matching search, searching
+    only those books where calibre allows it.
+
+    Given marked_ids, a copy of db.data.marked_ids, only db.new_api is
+    used, which can be called from other threads.
+    '''
+    from calibre.db.view import MarkedVirtualField
+    if marked_ids is None:
+        marked_ids = db.data.marked_ids
+    virtual_fields = {'marked':MarkedVirtualField(marked_ids)}
+    book_ids = set(book_ids)
+    try:
+        return set(db.new_api.search(search, '', virtual_fields=virtual_fields,
+                                     book_ids=book_ids))
+    except TypeError:
+        # calibre without book_ids.
+        return set(db.new_api.search(search, '', virtual_fields=virtual_fields)) & book_ids
+
+def search_library(gui, key, search, scope=None):
+    '''
+    Returns an IdSet of library book ids matching search, using the
+    native evaluation when search is the default.  If scope is given,
+    only books in it are searched.
+    '''
+    db = gui.library_view.model().db
+    if key in native_library_searches and is_native_search(key, search):
+        return native_library_searches[key](gui, db, scope=scope)
+    if scope is not None:
+        return search_book_ids(db, search, library_candidates(db, scope))
+    return IdSet(db.search_getting_ids(search, None))
+
+def search_device(model, key, search):
+    '''
+    Returns an IdSet of indexes into model.db matching search without
+    changing what the device view is showing.
+    '''
+    if is_native_search(key, search):
+        return native_notinlibrary(model)
+    return IdSet(model.search_engine.parse(search))
+
+def matching_device_ids(model, search, indexes):
+    '''
+    Returns the set of indexes among indexes into model.db matching
+    search, searching only those books where calibre allows it.
+    '''
+    indexes = set(indexes)
+    try:
+        return set(model.search_engine.parse(search, candidates=indexes))
+    except TypeError:
+        # calibre without candidates.
+        return set(model.search_engine.parse(search)) & indexes
+
+def iter_chunks(ids):
+    '''
+    Yields slices of the list ids, FIRST_ANY_CHUNK long and doubling.
+    '''
+    start = 0
+    size = FIRST_ANY_CHUNK
+    while start < len(ids):
+        yield ids[start:start+size]
+        start += size
+        size *= 2
+
+def any_library_match(gui, key, search, scope=None):
+    '''
+    True if search matches any library book (in scope, if given),
+    stopping at the first chunk of books with a match instead of
+    searching them all.
+    '''
+    db = gui.library_view.model().db
+    if key in native_library_searches and is_native_search(key, search):
+        # already cheap.
+        return bool(search_library(gui, key, search, scope))
+    for chunk in iter_chunks(library_candidates(db, scope)):
+        if matching_book_ids(db, search, chunk):
+            return True
+    return False
+
+# How a device's checks can be limited, and the search for each.
+SCOPE_TYPES = ['virtual_library', 'tag', 'saved_search']
+
+def scope_search(db, scope):
+    '''
+    Returns the search for the books in scope, a dict with type (one of
+    SCOPE_TYPES) and value, or None if scope doesn't limit anything.
+    '''
+    if not scope or not scope.get('value'):
+        return None
+    value = scope['value']
+    if scope.get('type') == 'virtual_library':
+        return db.prefs.get('virtual_libraries', {}).get(value)
+    if scope.get('type') == 'tag':
+        return 'tags:"=%s"'%value.replace('"','\\"')
+    if scope.get('type') == 'saved_search':
+        return 'search:"=%s"'%value.replace('"','\\"')
+    return None
+
+def scope_ids(db, search):
+    '''
+    IdSet of all library books matching search, ignoring the current
+    virtual library.
+    '''
+    try:
+        return IdSet(db.search_getting_ids(search, None, use_virtual_library=False))
+    except TypeError:
+        return IdSet(db.search_getting_ids(search, None))
+
+def any_device_match(model, key, search):
+    '''
+    True if search matches any book in model.db, stopping early like
+    any_library_match().
+    '''
+    if is_native_search(key, search):
+        for book in model.db:
+            if is_notinlibrary(book):
+                return True
+        return False
+    for chunk in iter_chunks(list(range(len(model.db)))):
+        if matching_device_ids(model, search, chunk):
+            return True
+    return False
+
+def is_library_search(key, search):
+    '''
+    True if search for key is run by calibre's library search, which
+    matching_book_ids() can do away from the GUI thread.  The device
+    searches and SmartEject's own evaluation of the defaults use the
+    device book lists, which belong to the GUI thread.
+    '''
+    return key in native_library_searches and not is_native_search(key, search)
+
+def count_matches(gui, key, search, scope=None):
+    '''
+    Returns how many books search matches: library books (in scope, if
+    given), or device books over all locations for
+    checknotinlibrary_search.  Must be called on the GUI thread.
+    '''
+    if key == 'checknotinlibrary_search':
+        if not gui.device_manager.is_device_connected:
+            return 0
+        return sum([ len(search_device(view.model(), key, search))
+                     for view in (gui.memory_view, gui.card_a_view, gui.card_b_view) ])
+    return len(search_library(gui, key, search, scope))
+
+def native_agrees(gui, key, search):
+    '''
+    True if SmartEject's own evaluation of the default search for key
+    finds the same books as calibre's search does on the current
+    library and device.
+    '''
+    if key == 'checknotinlibrary_search':
+        if not gui.device_manager.is_device_connected:
+            return True
+        return all([ native_notinlibrary(view.model()) == IdSet(view.model().search_engine.parse(search))
+                     for view in (gui.memory_view, gui.card_a_view, gui.card_b_view) ])
+    db = gui.library_view.model().db
+    return native_library_searches[key](gui, db) == IdSet(db.search_getting_ids(search, None))
+
+def check_search(gui, key, search):
+    '''
+    Parse and time search against the current library (and device, for
+    checknotinlibrary_search).  Returns a list of warnings, empty if
+    nothing was found to complain about.
+    '''
+    warnings = analyze_search(search)
+    try:
+        if key == 'checknotinlibrary_search':
+            seconds = 0
+            if gui.device_manager.is_device_connected:
+                for view in (gui.memory_view, gui.card_a_view, gui.card_b_view):
+                    seconds += time_call(search_device, view.model(), key, search)[1]
+        else:
+            seconds = time_call(search_library, gui, key, search)[1]
+    except Exception as e:
+        return [_('Search failed: %s')%e]
+    if seconds > SLOW_SEARCH_SECONDS:
+        warnings.append(_('Search took %.1f seconds on the current library.')%seconds)
+    if is_native_search(key, search):
+        # already as fast as it gets, if it still means the same as
+        # calibre's search.
+        try:
+            if not native_agrees(gui, key, search):
+                return [_("SmartEject's fast check of this search found different books than calibre's search.  Please report this.")]
+        except Exception:
+            pass
+        return []
+    native = suggest_native(key, search)
+    if native:
+        warnings.append(_('Same as the default search %s, which SmartEject can check much faster.')%native)
+    return warnings
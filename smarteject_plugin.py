@@ -7,13 +7,19 @@ __license__   = 'GPL v3'
 __copyright__ = '2019, Jim Miller'
 __docformat__ = 'restructuredtext en'
 
-from calibre.gui2 import question_dialog
+from PyQt5.Qt import QTimer
 
 # The class that all interface action plugins must inherit from
 from calibre.gui2.actions import InterfaceAction
 
 from calibre_plugins.smarteject.common_utils import get_icon
-from calibre_plugins.smarteject.config import prefs, default_prefs
+from calibre_plugins.smarteject.config import prefs
+from calibre_plugins.smarteject.audit import AuditEngine, Prewarmer, DEVICE_LOCATIONS, BUSY_RETRY_MS
+from calibre_plugins.smarteject.fingerprints import mark_metadata_current
+from calibre_plugins.smarteject.pipeline import stage_classes, run_stages
+from calibre_plugins.smarteject.preconvert import PreConverter
+from calibre_plugins.smarteject.thumbnails import ThumbnailCache
+from calibre_plugins.smarteject.stages import mark_search
 
 # pulls in translation files for _() strings
 try:
@@ -74,104 +80,127 @@ class SmartEjectPlugin(InterfaceAction):
         # Call function when plugin triggered.
         self.qaction.triggered.connect(self.plugin_button)
 
+        self.audit = AuditEngine(self.gui)
+        self.prewarmer = Prewarmer(self.audit, self.gui)
+        self.prewarmer.progress.connect(self.prewarm_progress)
+        self.prewarmer.finished.connect(self.prewarm_finished)
+        self.preconverter = PreConverter(self.gui)
+        self.thumbnails = ThumbnailCache(self.gui)
+        self.waiting = False
+        self.reading_libraries = False
+
+    def initialization_complete(self):
+        # device views get new book lists (and count_changed) whenever
+        # the device's books change.
+        for (viewattr, viewname, locationname) in DEVICE_LOCATIONS:
+            getattr(self.gui, viewattr).model().count_changed_signal.connect(self.device_books_changed)
+
+    def device_books_changed(self, *args):
+        self.audit.device_books_changed()
+        self.restart_prewarm()
+
+    def device_connection_changed(self, is_connected):
+        self.audit.resolved = {}
+        self.audit.device_books_changed()
+        if not is_connected:
+            self.stop_waiting()
+        self.restart_prewarm()
+
+    def start_waiting(self):
+        '''
+        Eject as soon as the device jobs are done.  Watches the job
+        queue's job_done signal, no polling.
+        '''
+        self.waiting = True
+        self.gui.job_manager.job_done.connect(self.job_done)
+        self.qaction.setText(_('SmartEject (waiting)'))
+        self.qaction.setToolTip(_('Waiting for device jobs to finish before ejecting.  Click to cancel.'))
+        self.gui.status_bar.show_message(_('SmartEject will eject when device jobs finish'), 3000)
+
+    def stop_waiting(self):
+        if not self.waiting:
+            return
+        self.waiting = False
+        self.gui.job_manager.job_done.disconnect(self.job_done)
+        self.qaction.setText(_('SmartEject'))
+        self.qaction.setToolTip(self.action_spec[2])
+
+    def job_done(self, *args):
+        if not self.gui.job_manager.has_device_jobs(queued_also=True):
+            self.stop_waiting()
+            # let the finished jobs' own callbacks update the device
+            # book lists first.
+            QTimer.singleShot(0, self.plugin_button)
+
+    def restart_prewarm(self, *args):
+        self.prewarmer.start()
+
+    def prewarm_progress(self, done, total):
+        if prefs['showprewarmprogress']:
+            self.gui.status_bar.show_message(_('SmartEject pre-check: %d%%')%(100*done//total), 3000)
+
+    def prewarm_finished(self):
+        if prefs['showprewarmprogress']:
+            self.gui.status_bar.show_message(_('SmartEject pre-check done'), 3000)
+        self.audit.save()
+        self.prepare_sends()
+
+    def prepare_sends(self):
+        '''
+        Get books the not on device check would send ready to send.
+        '''
+        if prefs['checknotondevice'] and prefs['sendnotondevice'] \
+                and self.gui.device_manager.is_device_connected:
+            book_ids = self.audit.library_result('checknotondevice_search')
+            if prefs['preconvertnotondevice']:
+                self.preconverter.queue(book_ids)
+            self.thumbnails.prerender(book_ids)
+
     def plugin_button(self):
+        if self.reading_libraries:
+            # carries on by itself once the libraries are read.
+            return
+        if self.waiting:
+            # clicked again while waiting, cancel.
+            self.stop_waiting()
+            return
+        if prefs['ejectwhenidle'] and self.gui.device_manager.is_device_present \
+                and self.gui.job_manager.has_device_jobs(queued_also=True):
+            self.start_waiting()
+            return
+        if prefs['profilenexteject']:
+            # one time only.
+            prefs['profilenexteject'] = False
+            prefs.save_to_db()
+            from calibre_plugins.smarteject.profiling import run_profiled
+            run_profiled(self.smart_eject)
+        else:
+            self.smart_eject()
+
+    def smart_eject(self):
         if not self.gui.device_manager.is_device_present:
             # no device connected, silently skip.
             return
 
-        if 'Reading List' in self.gui.iactions and ( prefs['checkreadinglistsync']
-                                                     or prefs['checkreadinglistsyncfromdevice']):
-            rl_plugin = self.gui.iactions['Reading List']
-            list_names = rl_plugin.get_list_names(exclude_auto=True)
-            all_list_names = rl_plugin.get_list_names(exclude_auto=False)
-            auto_list_names = list(set(all_list_names) - set(list_names))
-            if self.gui.device_manager.is_device_connected:
-                sync_total = rl_plugin._count_books_for_connected_device()
-                ## why is this setting the enabled for RL?
-                ## Probably RL's rebuild_menus hasn't been called
-                # print(all_list_names)
-                # print(auto_list_names)
-                # print(sync_total)
-                rl_plugin.sync_now_action.setEnabled(bool(sync_total > 0) or len(auto_list_names) > 0)
-                if sync_total > 0 and prefs['checkreadinglistsync']:
-                    if question_dialog(self.gui, _("Sync Reading List?"), _("There are books that need syncing according to Reading List.<p>Sync Books?"), show_copy_button=False):
-                        rl_plugin.sync_now(force_sync=True)
-                        return
-                elif len(auto_list_names) > 0 and prefs['checkreadinglistsyncfromdevice']:
-                    if prefs['silentsyncfromdevice'] or question_dialog(self.gui, _("Sync Now Reading List?"), _("There are lists that could be sync'ed according to Reading List.<p>Sync before ejecting?"), show_copy_button=False):
-                        # print("doreadinglistsync")
-                        rl_plugin.sync_now(force_sync=True)
-
-        if prefs['checkdups']:
-            # As of Calibre 5.42, the duplicate search needs to change.
-            # Automatically change it if it's the old default search.
-            if prefs['checkdups_search'] == 'ondevice:"("':
-                prefs['checkdups_search'] = default_prefs['checkdups_search']
-                print("checkdups_search changed to new default value.")
-                prefs.save_to_db()
-            if self.gui.library_view.model().db.search_getting_ids(prefs['checkdups_search'], None):
-                dodelete = prefs['deletedups']
-                if dodelete:
-                    qtext = _("There are duplicate ebooks on the device.<p>Delete duplicates?  (Make sure you uncheck the ones you want to keep).")
-                else:
-                    qtext = _("There are duplicate ebooks on the device.<p>Display duplicates?")
-                if question_dialog(self.gui, _("Duplicates on Device"), qtext, show_copy_button=False):
-                    self.gui.location_manager._location_selected('library')
-                    self.gui.search.setEditText(prefs['checkdups_search'])
-                    self.gui.search.do_search()
-                    if dodelete:
-                        self.gui.library_view.selectAll()
-                        self.gui.iactions['Remove Books'].remove_matching_books_from_device()
-                    return
-
-        if prefs['checknotinlibrary']:
-            devices = [ (self.gui.memory_view, 'Main', 'main'),
-                        (self.gui.card_a_view, 'Card A', 'carda'),
-                        (self.gui.card_b_view, 'Card B', 'cardb') ]
-            for (view, viewname, locationname) in devices:
-                model = view.model()
-                savesearch = model.last_search
-                model.search(prefs['checknotinlibrary_search'])
-                if model.count() > 0:
-                    dodelete = prefs['deletenotinlibrary']
-                    if dodelete:
-                        qtext = _("There are books on the device in %s that are not in the Library.<p>Delete books not in Library?")%viewname
-                    else:
-                        qtext = _("There are books on the device in %s that are not in the Library.<p>Display books not in Library?")%viewname
-                    if question_dialog(self.gui, _("Books on Device not in Library"), qtext, show_copy_button=False):
-                        self.gui.search.setEditText(prefs['checknotinlibrary_search'])
-                        self.gui.search.do_search()
-                        self.gui.location_manager._location_selected(locationname)
-                        if dodelete:
-                            view.selectAll()
-                            # remove_matching_books_from_device()
-                            # always operates on library_view, can't
-                            # use here on device view.
-                            self.gui.iactions['Remove Books'].delete_books()
-                        return
-                model.search(savesearch)
-                #print("model.count():%s"%model.count())
-
-        if prefs['checknotondevice'] and self.gui.library_view.model().db.search_getting_ids(prefs['checknotondevice_search'], None):
-            dosend = prefs['sendnotondevice']
-            if dosend:
-                qtext = _("There are books in the Library that are not on the Device.<p>Send books not on Device?")
-            else:
-                qtext = _("There are books in the Library that are not on the Device.<p>Display books not on Device?")
-            if question_dialog(self.gui,
-                               _("Books in Library not on Device"),
-                               qtext,
-                               show_copy_button=False):
-                self.gui.location_manager._location_selected('library')
-                self.gui.search.setEditText(prefs['checknotondevice_search'])
-                self.gui.search.do_search()
-                if dosend:
-                    self.gui.library_view.selectAll()
-                    self.gui.iactions['Send To Device'].do_sync()
-                return
+        # whatever isn't pre-checked yet is done now.
+        self.prewarmer.stop()
+        # in case calibre changed the book lists without telling the
+        # device views.
+        self.audit.device_books_changed()
+        if not self.audit.other_libraries_ready():
+            self.wait_for_libraries()
+            return
+
+        stages = [ cls(self) for cls in stage_classes ]
+        if run_stages(stages, self.audit):
+            return
 
         self.gui.location_manager._location_selected('library')
 
+        # for the next time this device is connected, maybe after a
+        # restart.
+        self.audit.save()
+
         from calibre.gui2.device import device_name_for_plugboards
         device_name = device_name_for_plugboards(self.gui.device_manager.connected_device.__class__)
         # print(device_name)
@@ -183,9 +212,69 @@ class SmartEjectPlugin(InterfaceAction):
 
         # if one of the configured searchs, clear it.
         #print("self.gui.search.current_text :(%s)"%self.gui.search.current_text )
-        if self.gui.search.current_text in (prefs['checkdups_search'],prefs['checknotinlibrary_search'],prefs['checknotondevice_search']):
+        if self.gui.search.current_text in sum([ stage.searches() for stage in stages ], []):
             self.gui.search.clear()
 
+    def wait_for_libraries(self):
+        '''
+        Eject once the other libraries' index, being brought up to date
+        in the background, is ready.
+        '''
+        if not self.reading_libraries:
+            self.reading_libraries = True
+            self.gui.status_bar.show_message(_('SmartEject is reading the other libraries...'), 3000)
+            QTimer.singleShot(BUSY_RETRY_MS, self.libraries_read)
+
+    def libraries_read(self):
+        self.reading_libraries = False
+        self.smart_eject()
+
+    def update_device_metadata(self, book_ids):
+        '''
+        Update the metadata (and thumbnail) of just book_ids on the
+        device, the same way calibre does when it syncs all metadata.
+        '''
+        from calibre.gui2.threaded_jobs import FunctionDispatcher
+        db = self.gui.library_view.model().db
+        for booklist in self.gui.booklists():
+            for book in booklist:
+                book_id = getattr(book, 'application_id', None)
+                if book_id in book_ids:
+                    mi = db.new_api.get_metadata(book_id, get_cover=True, cover_as_data=True)
+                    book.smart_update(mi, replace_metadata=True)
+                    if mi.cover_data and mi.cover_data[1]:
+                        book.thumbnail = self.gui.cover_to_thumbnail(mi.cover_data[1])
+        plugboards = db.prefs.get('plugboards', {})
+        self.gui.device_manager.sync_booklists(FunctionDispatcher(self.gui.metadata_synced),
+                                               self.gui.booklists(), plugboards)
+        mark_metadata_current(self.gui, book_ids)
+        self.audit.reset()
+
+    def show_library_ids(self, ids, label):
+        '''
+        Show ids in the library view by marking them with label,
+        leaving any other marks alone.
+        '''
+        db = self.gui.library_view.model().db
+        marked = dict([ (k, v) for k, v in db.data.marked_ids.items() if v != label ])
+        marked.update(dict([ (book_id, label) for book_id in ids ]))
+        db.set_marked_ids(marked)
+        self.gui.location_manager._location_selected('library')
+        self.gui.search.setEditText(mark_search(label))
+        self.gui.search.do_search()
+
+    def library_changed(self, db):
+        # Load (and upgrade if needed) the new library's settings now
+        # rather than during the first eject.
+        prefs._get_prefs()
+        self.audit.reset()
+        self.restart_prewarm()
+
+    def shutting_down(self):
+        self.prewarmer.stop()
+        self.audit.save()
+
     def apply_settings(self):
-        # No need to do anything with prefs here, but we could.
-        prefs
+        # searches or checks may have changed.
+        self.audit.resolved = {}
+        self.restart_prewarm()
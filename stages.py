@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+from PyQt5.Qt import QModelIndex, QItemSelection, QItemSelectionModel
+
+from calibre.gui2 import question_dialog
+
+from calibre_plugins.smarteject.config import prefs
+from calibre_plugins.smarteject.audit import DEVICE_LOCATIONS
+from calibre_plugins.smarteject.searches import is_native_search
+from calibre_plugins.smarteject.fingerprints import find_stale, find_outdated_metadata
+from calibre_plugins.smarteject.pipeline import Stage, register_stage
+
+# pulls in translation files for _() strings
+try:
+    load_translations()
+except NameError:
+    pass # load_translations() added in calibre 1.9
+
+# Labels used to mark library books SmartEject wants to show.
+MARK_STALE = 'smarteject_stale'
+MARK_METADATA = 'smarteject_metadata'
+
+def mark_search(label):
+    return 'marked:"=%s"'%label
+
+# Relative costs.  A configured search that isn't the default has to
+# go through calibre's search, which costs a lot more.
+NATIVE_COST = 10
+SEARCH_COST = 50
+
+def search_cost(key, base):
+    return base * (1 if is_native_search(key, prefs[key]) else SEARCH_COST//NATIVE_COST)
+
+@register_stage
+class ReadingListStage(Stage):
+    name = 'readinglist'
+    cost = 1
+    # Reading List's own lists aren't tracked.
+    depends = None
+
+    def enabled(self):
+        return 'Reading List' in self.gui.iactions and ( prefs['checkreadinglistsync']
+                                                         or prefs['checkreadinglistsyncfromdevice'])
+
+    def check(self):
+        # Always act; Reading List's own counts are cheap.
+        return self.gui.device_manager.is_device_connected
+
+    def act(self, result):
+        rl_plugin = self.gui.iactions['Reading List']
+        list_names = rl_plugin.get_list_names(exclude_auto=True)
+        all_list_names = rl_plugin.get_list_names(exclude_auto=False)
+        auto_list_names = list(set(all_list_names) - set(list_names))
+        sync_total = rl_plugin._count_books_for_connected_device()
+        ## why is this setting the enabled for RL?
+        ## Probably RL's rebuild_menus hasn't been called
+        # print(all_list_names)
+        # print(auto_list_names)
+        # print(sync_total)
+        rl_plugin.sync_now_action.setEnabled(bool(sync_total > 0) or len(auto_list_names) > 0)
+        if sync_total > 0 and prefs['checkreadinglistsync']:
+            if question_dialog(self.gui, _("Sync Reading List?"), _("There are books that need syncing according to Reading List.<p>Sync Books?"), show_copy_button=False):
+                rl_plugin.sync_now(force_sync=True)
+                return True
+        elif len(auto_list_names) > 0 and prefs['checkreadinglistsyncfromdevice']:
+            if prefs['silentsyncfromdevice'] or question_dialog(self.gui, _("Sync Now Reading List?"), _("There are lists that could be sync'ed according to Reading List.<p>Sync before ejecting?"), show_copy_button=False):
+                # print("doreadinglistsync")
+                rl_plugin.sync_now(force_sync=True)
+        return False
+
+@register_stage
+class DupsStage(Stage):
+    name = 'dups'
+    after = ('readinglist',)
+
+    @property
+    def cost(self):
+        return search_cost('checkdups_search', NATIVE_COST)
+
+    def enabled(self):
+        return prefs['checkdups']
+
+    def known(self):
+        return self.audit.has_result('checkdups_search')
+
+    def check(self):
+        # calibre's search shows (or deletes) the books; only need to
+        # know there are some.
+        return self.audit.library_any('checkdups_search')
+
+    def act(self, result):
+        dodelete = prefs['deletedups']
+        if dodelete:
+            qtext = _("There are duplicate ebooks on the device.<p>Delete duplicates?  (Make sure you uncheck the ones you want to keep).")
+        else:
+            qtext = _("There are duplicate ebooks on the device.<p>Display duplicates?")
+        if question_dialog(self.gui, _("Duplicates on Device"), qtext, show_copy_button=False):
+            self.gui.location_manager._location_selected('library')
+            self.gui.search.setEditText(self.audit.display_search('checkdups_search'))
+            self.gui.search.do_search()
+            if dodelete:
+                self.gui.library_view.selectAll()
+                self.gui.iactions['Remove Books'].remove_matching_books_from_device()
+            return True
+        return False
+
+    def searches(self):
+        return [prefs['checkdups_search'], self.audit.display_search('checkdups_search')]
+
+class NotInLibraryStage(Stage):
+    '''
+    Registered once per device location below.
+    '''
+    location = 0
+    after = ('readinglist', 'dups')
+
+    @property
+    def cost(self):
+        return search_cost('checknotinlibrary_search', NATIVE_COST)
+
+    def enabled(self):
+        return prefs['checknotinlibrary']
+
+    def known(self):
+        return self.audit.has_result('checknotinlibrary_search', self.location)
+
+    def check(self):
+        return self.audit.device_any('checknotinlibrary_search', self.location)
+
+    def act(self, result):
+        (viewattr, viewname, locationname) = DEVICE_LOCATIONS[self.location]
+        view = getattr(self.gui, viewattr)
+        dodelete = prefs['deletenotinlibrary']
+        filtered = bool(self.audit.other_library_paths())
+        if dodelete:
+            qtext = _("There are books on the device in %s that are not in the Library.<p>Delete books not in Library?")%viewname
+        else:
+            qtext = _("There are books on the device in %s that are not in the Library.<p>Display books not in Library?")%viewname
+        if filtered:
+            qtext += '<p>'+_("Books in one of the other libraries will be shown, but not selected.")
+        if question_dialog(self.gui, _("Books on Device not in Library"), qtext, show_copy_button=False):
+            view.model().search(prefs['checknotinlibrary_search'])
+            self.gui.search.setEditText(prefs['checknotinlibrary_search'])
+            self.gui.search.do_search()
+            self.gui.location_manager._location_selected(locationname)
+            if filtered:
+                # the search also matches books in the other libraries.
+                self.select_found(view, self.audit.device_result('checknotinlibrary_search', self.location))
+            if dodelete:
+                if not filtered:
+                    view.selectAll()
+                # remove_matching_books_from_device()
+                # always operates on library_view, can't
+                # use here on device view.
+                self.gui.iactions['Remove Books'].delete_books()
+            return True
+        return False
+
+    def select_found(self, view, found):
+        '''
+        Select just the rows of device view showing the books in found,
+        indexes into its book list.
+        '''
+        model = view.model()
+        rows = [ model.index(row, 0) for row in range(model.rowCount(QModelIndex())) ]
+        last = model.columnCount(QModelIndex()) - 1
+        selection = QItemSelection()
+        for index, i in zip(rows, model.indices(rows)):
+            if i in found:
+                selection.select(index, model.index(index.row(), last))
+        view.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+
+    def searches(self):
+        return [prefs['checknotinlibrary_search']]
+
+@register_stage
+class NotInLibraryMainStage(NotInLibraryStage):
+    name = 'notinlibrary_main'
+    location = 0
+
+@register_stage
+class NotInLibraryCardAStage(NotInLibraryStage):
+    name = 'notinlibrary_carda'
+    location = 1
+    after = ('readinglist', 'dups', 'notinlibrary_main')
+
+@register_stage
+class NotInLibraryCardBStage(NotInLibraryStage):
+    name = 'notinlibrary_cardb'
+    location = 2
+    after = ('readinglist', 'dups', 'notinlibrary_carda')
+
+@register_stage
+class NotOnDeviceStage(Stage):
+    name = 'notondevice'
+    after = ('readinglist', 'dups')
+
+    @property
+    def cost(self):
+        return search_cost('checknotondevice_search', 2*NATIVE_COST)
+
+    def enabled(self):
+        return prefs['checknotondevice']
+
+    def known(self):
+        return self.audit.has_result('checknotondevice_search')
+
+    def check(self):
+        return self.audit.library_any('checknotondevice_search')
+
+    def act(self, result):
+        dosend = prefs['sendnotondevice']
+        if dosend:
+            qtext = _("There are books in the Library that are not on the Device.<p>Send books not on Device?")
+        else:
+            qtext = _("There are books in the Library that are not on the Device.<p>Display books not on Device?")
+        if question_dialog(self.gui,
+                           _("Books in Library not on Device"),
+                           qtext,
+                           show_copy_button=False):
+            self.gui.location_manager._location_selected('library')
+            self.gui.search.setEditText(self.audit.display_search('checknotondevice_search'))
+            self.gui.search.do_search()
+            if dosend:
+                self.gui.library_view.selectAll()
+                with self.plugin.thumbnails.installed():
+                    self.gui.iactions['Send To Device'].do_sync()
+            return True
+        return False
+
+    def searches(self):
+        return [prefs['checknotondevice_search'], self.audit.display_search('checknotondevice_search')]
+
+@register_stage
+class StaleStage(Stage):
+    name = 'stale'
+    # no point resending books that are about to be deleted.
+    after = ('readinglist', 'dups')
+
+    @property
+    def cost(self):
+        # stat()s every device book's library file, hashing is more.
+        return 2000 if prefs['stalehashes'] else 200
+
+    def enabled(self):
+        return prefs['checkstale']
+
+    def known(self):
+        return self.audit.has_cached('stale', find_stale, self.gui, prefs['stalehashes'])
+
+    def check(self):
+        return self.audit.cached('stale', find_stale, self.gui, prefs['stalehashes'])
+
+    def act(self, result):
+        dosend = prefs['sendstale']
+        if dosend:
+            qtext = _("There are books on the Device that have changed in the Library since they were sent.<p>Send them again?")
+        else:
+            qtext = _("There are books on the Device that have changed in the Library since they were sent.<p>Display outdated books?")
+        if question_dialog(self.gui,
+                           _("Outdated Books on Device"),
+                           qtext,
+                           show_copy_button=False):
+            self.plugin.show_library_ids(result, MARK_STALE)
+            if dosend:
+                self.gui.library_view.selectAll()
+                with self.plugin.thumbnails.installed():
+                    self.gui.iactions['Send To Device'].do_sync()
+            return True
+        return False
+
+    def searches(self):
+        return [mark_search(MARK_STALE)]
+
+@register_stage
+class MetadataStage(Stage):
+    name = 'metadata'
+    # resending a book updates its metadata too.
+    after = ('readinglist', 'dups', 'stale')
+    cost = 100
+
+    def enabled(self):
+        return prefs['checkmetadata']
+
+    def known(self):
+        return self.audit.has_cached('metadata', find_outdated_metadata, self.gui)
+
+    def check(self):
+        return self.audit.cached('metadata', find_outdated_metadata, self.gui)
+
+    def act(self, result):
+        doupdate = prefs['updatemetadata']
+        if doupdate:
+            qtext = _("There are books on the Device whose metadata has changed in the Library.<p>Update metadata on Device?")
+        else:
+            qtext = _("There are books on the Device whose metadata has changed in the Library.<p>Display books with changed metadata?")
+        if question_dialog(self.gui,
+                           _("Changed Metadata on Device"),
+                           qtext,
+                           show_copy_button=False):
+            if doupdate:
+                self.plugin.update_device_metadata(result)
+            else:
+                self.plugin.show_library_ids(result, MARK_METADATA)
+            return True
+        return False
+
+    def searches(self):
+        return [mark_search(MARK_METADATA)]
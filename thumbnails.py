@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import hashlib, threading
+from itertools import islice
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+# Threads scaling covers.  Qt's image scaling lets other threads run.
+THUMBNAIL_THREADS = 4
+
+# Most thumbnails pre-rendered and kept at once.
+MAX_THUMBNAILS = 300
+
+def cover_key(data):
+    return hashlib.sha1(data).hexdigest()
+
+class ThumbnailCache(object):
+    '''
+    Device thumbnails for covers, rendered ahead of time in a thread
+    pool and looked up by a hash of the cover, so sends started by
+    SmartEject don't scale covers one at a time.
+    '''
+    def __init__(self, gui):
+        self.gui = gui
+        self.thumbnails = {}
+        self.device_key = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def current_device_key(self):
+        device = self.gui.device_manager.device
+        return (device.__class__.__name__,
+                getattr(device, 'THUMBNAIL_WIDTH', None),
+                getattr(device, 'THUMBNAIL_HEIGHT', None),
+                getattr(device, 'THUMBNAIL_COMPRESSION_QUALITY', None))
+
+    def check_device(self):
+        key = self.current_device_key()
+        if key != self.device_key:
+            with self.lock:
+                self.thumbnails = {}
+                self.device_key = key
+
+    def prerender(self, book_ids):
+        '''
+        Start rendering thumbnails for up to MAX_THUMBNAILS of book_ids
+        in the background.  Does nothing if already running.
+        '''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.check_device()
+        book_ids = list(islice(book_ids, MAX_THUMBNAILS))
+        self.thread = threading.Thread(target=self._prerender,
+                                       args=(self.gui.current_db.new_api, book_ids),
+                                       name='SmartEject thumbnails')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _prerender(self, api, book_ids):
+        def render(book_id):
+            try:
+                data = api.cover(book_id)
+                if data:
+                    key = cover_key(data)
+                    if key not in self.thumbnails:
+                        return (key, self.render(data))
+            except Exception:
+                pass
+            return (None, None)
+        pool = ThreadPool(THUMBNAIL_THREADS)
+        try:
+            results = pool.map(render, book_ids)
+        finally:
+            pool.close()
+        with self.lock:
+            for key, thumbnail in results:
+                if key and thumbnail and len(self.thumbnails) < MAX_THUMBNAILS:
+                    self.thumbnails[key] = thumbnail
+
+    def render(self, data):
+        # the gui's own cover_to_thumbnail, even while installed() has
+        # replaced it.
+        return type(self.gui).cover_to_thumbnail(self.gui, data)
+
+    def cover_to_thumbnail(self, data):
+        with self.lock:
+            thumbnail = self.thumbnails.get(cover_key(data))
+        if thumbnail is None:
+            thumbnail = self.render(data)
+        return thumbnail
+
+    @contextmanager
+    def installed(self):
+        '''
+        Within this, the gui's cover_to_thumbnail() uses the cache.
+        '''
+        self.check_device()
+        self.gui.cover_to_thumbnail = self.cover_to_thumbnail
+        try:
+            yield
+        finally:
+            del self.gui.cover_to_thumbnail
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Jim Miller'
+__docformat__ = 'restructuredtext en'
+
+import os, json, zlib, base64, hashlib, traceback
+
+from calibre.utils.config import config_dir
+
+from calibre_plugins.smarteject.idset import IdSet
+from calibre_plugins.smarteject.fingerprints import get_device_uuid
+
+# Only search results are saved.  The stale and metadata checks
+# depend on more than the library and device stamps.
+SAVED_KEYS = ('checkdups_search', 'checknotinlibrary_search', 'checknotondevice_search')
+
+def cache_path():
+    return os.path.join(config_dir, 'plugins', 'SmartEject', 'audit_cache.json.z')
+
+def load_cache():
+    '''
+    Returns the saved results, library uuid -> entry, or {} if there
+    are none or they can't be read.
+    '''
+    try:
+        with open(cache_path(), 'rb') as f:
+            return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except Exception:
+        return {}
+
+def save_cache(cache):
+    path = cache_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    data = zlib.compress(json.dumps(cache, separators=(',',':')).encode('utf-8'))
+    tmp = path+'.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+
+def library_stamp(db):
+    '''
+    Like AuditEngine.library_stamp(), but as saved.
+    '''
+    from calibre_plugins.smarteject.common_utils import get_library_uuid
+    try:
+        restriction = db.data.get_base_restriction()
+    except:
+        restriction = None
+    return [get_library_uuid(db), '%s'%db.last_modified(), restriction]
+
+def device_books_stamp(gui):
+    '''
+    Stamp of the connected device's book lists that, unlike
+    AuditEngine.device_stamp(), still means the same after a restart:
+    the device's uuid and a hash of each book list's files in order.
+    The saved device results are indexes into those lists.
+    '''
+    if not gui.device_manager.is_device_connected:
+        return None
+    stamps = []
+    for bl in gui.booklists():
+        h = hashlib.sha1()
+        for book in bl:
+            h.update(('%s\0%s\0'%(getattr(book, 'lpath', ''), getattr(book, 'size', ''))).encode('utf-8'))
+        stamps.append([len(bl), h.hexdigest()])
+    return [get_device_uuid(gui), stamps]
+
+def as_tuple(value):
+    '''
+    JSON turns tuples into lists, turn them back.
+    '''
+    if isinstance(value, list):
+        return tuple([ as_tuple(v) for v in value ])
+    return value
+
+def encode_ids(ids):
+    return base64.b64encode(ids.to_bytes()).decode('ascii')
+
+def decode_ids(data):
+    return IdSet.from_bytes(base64.b64decode(data))
+
+def saved_key(rk):
+    return rk[0] in SAVED_KEYS or (rk[0] == 'any' and rk[1] in SAVED_KEYS)
+
+def encode_results(results):
+    '''
+    The saveable entries of AuditEngine.results as a list of
+    [key, ids, any].
+    '''
+    encoded = []
+    for rk, value in results.items():
+        if not saved_key(rk):
+            continue
+        if isinstance(value, IdSet):
+            encoded.append([rk, encode_ids(value), None])
+        elif isinstance(value, bool):
+            encoded.append([rk, None, value])
+    return encoded
+
+def decode_results(encoded):
+    results = {}
+    for rk, ids, anymatch in encoded:
+        results[as_tuple(rk)] = anymatch if ids is None else decode_ids(ids)
+    return results
+
+def write_entry(gui, results, scopes):
+    '''
+    Save results and scopes, which must be for the current library and
+    device, replacing any saved before for this library.
+    '''
+    try:
+        db = gui.current_db
+        device = device_books_stamp(gui)
+        if device is None:
+            return
+        library = library_stamp(db)
+        cache = load_cache()
+        cache[library[0]] = {'library':library,
+                             'device':device,
+                             'results':encode_results(results),
+                             'scopes':[ [search, encode_ids(ids)]
+                                        for (stamp, search), ids in scopes.items() ]}
+        save_cache(cache)
+    except Exception:
+        traceback.print_exc()
+
+def read_entry(gui, cache):
+    '''
+    Take the current library's entry out of cache and return its
+    (results, scopes by search) if it still matches the library and
+    connected device.  Library only scopes are returned even if the
+    device has changed.
+    '''
+    db = gui.current_db
+    library = library_stamp(db)
+    entry = cache.pop(library[0], None)
+    if not entry or entry['library'] != library:
+        return ({}, {})
+    try:
+        scopes = dict([ (search, decode_ids(ids)) for search, ids in entry['scopes'] ])
+        if entry['device'] != device_books_stamp(gui):
+            return ({}, scopes)
+        return (decode_results(entry['results']), scopes)
+    except Exception:
+        traceback.print_exc()
+        return ({}, {})